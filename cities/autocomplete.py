@@ -0,0 +1,671 @@
+"""
+Maintenance of the cities_table_autocomplete_<language> cache tables.
+
+Place.save() refreshes the rows of the saved place. Inside
+deferred_autocomplete() the refresh is postponed: the ids are collected
+and rewritten in one pass when the outermost block exits, eg. around an
+import. rebuild() recreates the whole tables from an in-memory index of
+the place hierarchy. Renaming or moving a place rewrites the rows of its
+descendants with refresh_subordinates(), in the request or in a
+background thread (CITIES_AUTOCOMPLETE_ASYNC).
+
+search() reads them: a prefix search on the accent and case folded names
+(the indexed search_name column), best ranked places first, optionally
+answered from an in-process sorted array per language
+(CITIES_AUTOCOMPLETE_CACHE).
+"""
+
+import time
+import heapq
+import Queue
+import logging
+import threading
+import unicodedata
+from bisect import bisect_left
+from itertools import islice
+from collections import defaultdict
+from contextlib import contextmanager
+from django.db import connections, transaction, reset_queries
+from django.utils import translation
+from conf import settings
+from util import keyset, LRUCache
+import placecache
+
+table_prefix = 'cities_table_autocomplete_'
+
+# above this many deferred ids the tables are rebuilt instead of refreshed
+rebuild_threshold = 50000
+
+_state = threading.local()
+_tables = {}
+_search_columns = {}
+
+def autocomplete_tables(using='default', refresh=False):
+    """Map language -> autocomplete table name, for the tables that exist"""
+    if refresh or using not in _tables:
+        existing = set(connections[using].introspection.table_names())
+        _tables[using] = dict(
+            (language, table_prefix + language[:2])
+            for language in settings.autocomplete_languages
+            if table_prefix + language[:2] in existing
+        )
+    return _tables[using]
+
+def has_search_name(using='default'):
+    """Whether the autocomplete tables have the search_name column, see README"""
+    if using not in _search_columns:
+        tables = autocomplete_tables(using)
+        columns = []
+        if tables:
+            connection = connections[using]
+            description = connection.introspection.get_table_description(connection.cursor(), tables.values()[0])
+            columns = [column[0] for column in description]
+        _search_columns[using] = 'search_name' in columns
+    return _search_columns[using]
+
+def normalize(text):
+    """Accent and case folded text, the form searched by search()"""
+    text = unicodedata.normalize('NFKD', unicode(text))
+    text = u"".join([c for c in text if not unicodedata.combining(c)])
+    return u" ".join(text.lower().split())
+
+def row_values(id, name, slug, active, deleted, ranking, search_name):
+    values = [id, name, slug, active, deleted, ranking]
+    if search_name: values.append(normalize(name))
+    return values
+
+def insert_sql(table, using='default'):
+    columns = "id, name, slug, active, deleted, ranking"
+    if has_search_name(using): columns += ", search_name"
+    return "INSERT INTO {0} ({1}) VALUES ({2})".format(
+        connections[using].ops.quote_name(table), columns, ", ".join(["%s"] * len(columns.split(", "))))
+
+def is_deferred():
+    return getattr(_state, 'depth', 0) > 0
+
+def defer(ids):
+    """Record place ids to refresh when the deferred block exits"""
+    _state.ids.update(ids)
+
+def take_deferred():
+    """Remove and return the ids recorded so far, eg. to hand them to another process"""
+    if not is_deferred(): return set()
+    ids, _state.ids = _state.ids, set()
+    return ids
+
+@contextmanager
+def deferred_autocomplete(refresh=True, using='default'):
+    """Suppress per-save autocomplete updates, refresh them all at the end"""
+    if not is_deferred():
+        _state.depth = 0
+        _state.ids = set()
+    _state.depth += 1
+    try:
+        yield
+    finally:
+        _state.depth -= 1
+        if not _state.depth:
+            ids, _state.ids = _state.ids, set()
+            if refresh and len(ids) > rebuild_threshold:
+                rebuild(using=using)
+            elif refresh and ids:
+                refresh_places(sorted(ids), using=using)
+
+def refresh_places(ids, using='default', chunk_size=1000):
+    """Rewrite the autocomplete rows of the given place ids"""
+    from models import Place, prefetch_hierarchy, translate_many
+
+    # the cached names would be written back to the rows
+    placecache.invalidate(ids)
+    tables = autocomplete_tables(using, refresh=True)
+    if not tables: return
+    qn = connections[using].ops.quote_name
+    search_name = has_search_name(using)
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        places = list(Place.objects.using(using).filter(id__in=chunk))
+        # hierarchies and translated names of the chunk in a few queries,
+        # placecache reads the translations itself for the languages it keeps
+        prefetch_hierarchy(places)
+        names = {}
+        for language in tables.keys():
+            if not placecache.enabled() or language[:2] not in settings.cache_languages:
+                translate_many(places, language)
+            names[language] = placecache.translated_names(places, language)
+        urls = placecache.absolute_urls(places)
+        with transaction.commit_on_success(using=using):
+            cursor = connections[using].cursor()
+            for language, table in tables.items():
+                cursor.execute("DELETE FROM {0} WHERE id IN ({1})".format(
+                    qn(table), ", ".join(["%s"] * len(chunk))
+                ), chunk)
+                cursor.executemany(insert_sql(table, using), [
+                    row_values(place.id, names[language][place.id].replace("'", '"'), urls[place.id],
+                               place.active, place.deleted, place.ranking, search_name) for place in places
+                ])
+        # free some memory
+        # https://docs.djangoproject.com/en/dev/faq/models/
+        reset_queries()
+    update_caches(ids, using)
+
+def subordinate_ids(place, chunk_size=10000):
+    """Ids of the descendants of place, streamed in id order"""
+    from models import Place
+
+    if not place.ancestor_ids:
+        # paths not computed yet
+        for id in place.iter_subordinates(ids=True, chunk_size=chunk_size):
+            yield id
+        return
+    descendants = Place.objects.filter(ancestor_ids__startswith=place.ancestor_ids + str(place.id) + ',')
+    for row in keyset(descendants, [], chunk_size):
+        yield row[0]
+
+def refresh_subordinates(place, using='default', chunk_size=1000):
+    """Rewrite the autocomplete rows of the descendants of place, chunk by chunk"""
+    ids = subordinate_ids(place)
+    while True:
+        chunk = list(islice(ids, chunk_size))
+        if not chunk: break
+        refresh_places(chunk, using, chunk_size)
+
+logger = logging.getLogger("cities")
+_queue = None
+_queue_lock = threading.Lock()
+
+def refresh_subordinates_async(place, changed=None):
+    """
+    Queue refresh_subordinates(place) to the background thread, started on
+    first use. changed is the saved object whose new values the thread waits
+    to read before refreshing, the place itself by default.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = Queue.Queue()
+            thread = threading.Thread(target=refresh_worker, name='cities-autocomplete')
+            thread.daemon = True
+            thread.start()
+    _queue.put((place.id, saved_values(changed or place), 0))
+
+def saved_values(obj):
+    """(model, pk, {field: value}) of the fields of obj a refresh depends on"""
+    from models import Place
+
+    if isinstance(obj, Place):
+        model, fields = Place, ['name', 'slug_path']
+    else:
+        model, fields = type(obj), ['name', 'language', 'is_preferred', 'active', 'deleted']
+    return model, obj.pk, dict((field, getattr(obj, field)) for field in fields)
+
+def refresh_worker(retries=20, delay=0.5):
+    from models import Place, forget_translations
+
+    while True:
+        id, (model, pk, values), tries = _queue.get()
+        try:
+            current = model.objects.filter(pk=pk).values(*values.keys())
+            if (not current or current[0] != values) and tries < retries:
+                # the transaction of the save is not committed yet
+                time.sleep(delay)
+                _queue.put((id, (model, pk, values), tries + 1))
+                continue
+            # names read by other threads before the commit
+            forget_translations([id])
+            refresh_subordinates(Place.objects.get(pk=id))
+        except Exception:
+            logger.exception("Refreshing the autocomplete rows below place {0} failed".format(id))
+        finally:
+            # the thread has its own connection, do not keep it open between jobs
+            connections['default'].close()
+            _queue.task_done()
+
+class NameIndex(object):
+    """
+    Names, slugs and parents of every place held in memory, so the
+    autocomplete row of a place is built without querying its hierarchy.
+    """
+
+    def __init__(self, languages, using='default', chunk_size=10000):
+        self.using = using
+        self.chunk_size = chunk_size
+        self.names = {}
+        self.slugs = {}
+        self.parents = {}
+        self.translations = {}
+        self.load_places()
+        self.load_parents()
+        for language in languages:
+            self.load_translations(language)
+
+    def load_places(self):
+        from models import Place
+
+        for id, name, slug in keyset(Place.objects.using(self.using), ['name', 'slug'], self.chunk_size):
+            self.names[id] = name
+            self.slugs[id] = slug
+
+    def load_parents(self):
+        from models import Continente, Country, Region, Subregion, City, District, PostalCode
+
+        continents = dict(Continente.objects.using(self.using).values_list('code', 'pk'))
+        for id, continent in Country.objects.using(self.using).values_list('pk', 'continent').iterator():
+            self.parents[id] = continents.get(continent)
+        for model, parent in [(Region, 'country'), (Subregion, 'region'), (City, 'region'),
+                              (District, 'city'), (PostalCode, 'country')]:
+            self.parents.update(model.objects.using(self.using).values_list('pk', parent).iterator())
+
+    def load_translations(self, language):
+        from models import Place, preferred_names
+
+        alt_names = Place.alt_names.through.objects.using(self.using).filter(
+            alternativename__language__startswith=language[:2],
+            alternativename__active=True,
+            alternativename__deleted=False,
+        ).values_list('place', 'alternativename__name', 'alternativename__is_preferred')
+        self.translations[language] = preferred_names(alt_names.iterator())
+
+    def hierarchy(self, id):
+        """Ids of the place and its ancestors, place first"""
+        ids = []
+        while id is not None and id not in ids:
+            ids.append(id)
+            id = self.parents.get(id)
+        return ids
+
+    def translated_name(self, id, language):
+        names = self.translations.get(language, {})
+        return ", ".join([names.get(e) or self.names[e] for e in self.hierarchy(id)])
+
+    def get_absolute_url(self, id):
+        return "/".join([self.slugs[e] for e in self.hierarchy(id)])
+
+# the index of the running rebuild, inherited by forked workers
+_index = None
+
+def rebuild(using='default', workers=1, chunk_size=1000):
+    """
+    Rebuild every autocomplete table into a shadow table, computing the
+    rows from a NameIndex, then swap the shadow tables in. With workers > 1
+    the place id range is split into shards built by a process pool.
+    Databases other than PostgreSQL and MySQL (eg. SpatiaLite) have their
+    tables emptied and refilled in one transaction instead.
+    """
+    global _index
+    from models import Place
+
+    tables = autocomplete_tables(using, refresh=True)
+    if not tables: return
+    if connections[using].vendor not in ('postgresql', 'mysql'):
+        rebuild_in_place(tables, using, chunk_size)
+        placecache.invalidate_all()
+        return
+
+    shadows = dict((table, table + '_shadow') for table in tables.values())
+    for table, shadow in shadows.items():
+        create_shadow(table, shadow, using)
+
+    _index = NameIndex(tables.keys(), using)
+    shards = id_ranges(Place.objects.using(using), workers)
+    jobs = [(lo, hi, tables, shadows, using, chunk_size) for lo, hi in shards]
+    try:
+        if workers > 1:
+            from multiprocessing import Pool
+            # the workers must open their own connections
+            connections[using].close()
+            pool = Pool(workers)
+            try:
+                pool.map(build_shard, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                build_shard(job)
+    finally:
+        _index = None
+
+    swap_shadows(shadows, using)
+    placecache.invalidate_all()
+
+def id_ranges(queryset, count):
+    """Split the pk range of queryset into count [lo, hi] ranges"""
+    from django.db.models import Min, Max
+
+    bounds = queryset.aggregate(lo=Min('pk'), hi=Max('pk'))
+    if bounds['lo'] is None: return []
+    lo, hi = bounds['lo'], bounds['hi']
+    step = (hi - lo) // count + 1
+    return [(start, min(start + step - 1, hi)) for start in range(lo, hi + 1, step)]
+
+def build_shard(job):
+    from models import Place
+
+    lo, hi, tables, shadows, using, chunk_size = job
+    places = Place.objects.using(using).filter(pk__gte=lo, pk__lte=hi)
+    for chunk in row_chunks(places, chunk_size):
+        with transaction.commit_on_success(using=using):
+            insert_rows(_index, chunk, tables, shadows, using)
+        reset_queries()
+
+def rebuild_in_place(tables, using='default', chunk_size=1000):
+    """Empty and refill the tables in one transaction, readers see the old rows until it commits"""
+    from models import Place
+
+    index = NameIndex(tables.keys(), using)
+    qn = connections[using].ops.quote_name
+    targets = dict((table, table) for table in tables.values())
+    with transaction.commit_on_success(using=using):
+        cursor = connections[using].cursor()
+        for table in tables.values():
+            cursor.execute("DELETE FROM {0}".format(qn(table)))
+        for chunk in row_chunks(Place.objects.using(using), chunk_size):
+            insert_rows(index, chunk, tables, targets, using)
+            reset_queries()
+
+def row_chunks(places, chunk_size):
+    """(id, active, deleted, ranking) rows of places, chunk_size at a time"""
+    rows = keyset(places, ['active', 'deleted', 'ranking'], chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk: break
+        yield chunk
+
+def insert_rows(index, chunk, tables, targets, using='default'):
+    """Insert the rows of chunk into targets[table] for every language table"""
+    search_name = has_search_name(using)
+    cursor = connections[using].cursor()
+    for language, table in tables.items():
+        cursor.executemany(insert_sql(targets[table], using), [
+            row_values(id, index.translated_name(id, language).replace("'", '"'), index.get_absolute_url(id),
+                       active, deleted, ranking, search_name) for id, active, deleted, ranking in chunk
+        ])
+
+def create_shadow(table, shadow, using='default'):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    with transaction.commit_on_success(using=using):
+        if connection.vendor == 'postgresql':
+            cursor.execute("DROP TABLE IF EXISTS {0}".format(qn(shadow)))
+            cursor.execute("CREATE TABLE {0} (LIKE {1} INCLUDING ALL)".format(qn(shadow), qn(table)))
+        elif connection.vendor == 'mysql':
+            cursor.execute("DROP TABLE IF EXISTS {0}".format(qn(shadow)))
+            cursor.execute("CREATE TABLE {0} LIKE {1}".format(qn(shadow), qn(table)))
+        else:
+            raise ValueError("Rebuilding the autocomplete tables is not supported on " + connection.vendor)
+
+def swap_shadows(shadows, using='default'):
+    """Replace every table by its shadow in one step"""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    with transaction.commit_on_success(using=using):
+        if connection.vendor == 'mysql':
+            renames = []
+            for table, shadow in shadows.items():
+                renames += ["{0} TO {1}".format(qn(table), qn(table + '_old')),
+                            "{0} TO {1}".format(qn(shadow), qn(table))]
+            cursor.execute("RENAME TABLE " + ", ".join(renames))
+        else:
+            # DDL is transactional on PostgreSQL
+            for table, shadow in shadows.items():
+                cursor.execute("ALTER TABLE {0} RENAME TO {1}".format(qn(table), qn(table + '_old')))
+                cursor.execute("ALTER TABLE {0} RENAME TO {1}".format(qn(shadow), qn(table)))
+        for table in shadows.keys():
+            cursor.execute("DROP TABLE {0}".format(qn(table + '_old')))
+
+def search(query, language=None, limit=10, using='default'):
+    """
+    Places whose translated name starts with query, ignoring accents and
+    case, best ranked first: a list of (id, name, slug).
+    """
+    prefix = normalize(query)
+    if not prefix: return []
+    language = (language or translation.get_language() or settings.autocomplete_languages[0])[:2]
+    table = table_prefix + language
+    if table not in autocomplete_tables(using).values():
+        raise ValueError("No autocomplete table for language " + language)
+    if settings.autocomplete_cache:
+        return prefix_cache(table, using).search(prefix, limit)
+    return search_table(table, prefix, limit, using)
+
+def search_table(table, prefix, limit=10, using='default'):
+    connection = connections[using]
+    column = "search_name" if has_search_name(using) else "LOWER(name)"
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT id, name, slug FROM {0} WHERE {1} LIKE %s AND active = %s AND deleted = %s "
+        "ORDER BY ranking DESC LIMIT %s".format(connection.ops.quote_name(table), column),
+        [pattern, True, False, limit]
+    )
+    return [tuple(row) for row in cursor.fetchall()]
+
+_caches = {}
+
+def prefix_cache(table, using='default'):
+    key = (table, using)
+    if key not in _caches:
+        _caches[key] = PrefixCache(table, using)
+    return _caches[key]
+
+def update_caches(ids, using='default'):
+    """Reload the rows of the given place ids in the prefix caches of this process"""
+    for (table, cache_using), cache in _caches.items():
+        if cache_using == using:
+            cache.update(ids)
+
+class PrefixCache(object):
+    """
+    The active rows of an autocomplete table sorted by normalized name, so
+    a prefix is a range found by binary search. The best ranked rows of
+    the prefixes of up to short_prefix characters, whose ranges span most
+    of the table, are kept apart. Results are memoized.
+
+    update() removes and inserts the rows of some ids and recomputes the
+    best rows of their prefixes only: in place for a few ids, in copies
+    swapped in for larger batches. The whole table is reloaded in a
+    background thread every max_age seconds, searches keep using the
+    loaded rows meanwhile.
+    """
+    short_prefix = 2
+    top_k = 50
+    # more changed rows than this are merged into copies of the lists
+    max_in_place = 32
+
+    def __init__(self, table, using='default', max_age=None, results=10000):
+        self.table = table
+        self.using = using
+        self.max_age = settings.autocomplete_cache_age if max_age is None else max_age
+        self.results = LRUCache(results)
+        # guards rows, keys and tops, held by searches and while they change
+        self.lock = threading.Lock()
+        # one writer at a time, update() or the end of a reload
+        self.write_lock = threading.Lock()
+        self.reloading = False
+        # ids updated while a reload reads the table
+        self.pending = None
+        self.rows = None
+        self.load()
+
+    def select(self, where="", params=()):
+        connection = connections[self.using]
+        column = "search_name" if has_search_name(self.using) else "NULL"
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT {0}, ranking, id, name, slug FROM {1} WHERE active = %s AND deleted = %s {2}".format(
+                column, connection.ops.quote_name(self.table), where),
+            [True, False] + list(params)
+        )
+        return [(key or normalize(name), ranking or 0, id, name, slug) for key, ranking, id, name, slug in cursor.fetchall()]
+
+    def load(self):
+        with self.write_lock:
+            self.pending = set()
+        rows = sorted(self.select())
+        with self.write_lock:
+            pending, self.pending = self.pending, None
+            if rows == self.rows:
+                # nothing changed, keep the memoized results
+                self.loaded = time.time()
+            else:
+                tops = self.best_rows(rows)
+                self.by_id = dict((row[2], row) for row in rows)
+                with self.lock:
+                    self.rows, self.keys, self.tops = rows, [row[0] for row in rows], tops
+                    self.loaded = time.time()
+                    self.forget(None)
+        # rows updated while the table was read may be older in rows
+        self.update(pending)
+
+    def best_rows(self, rows):
+        """{prefix: its top_k best ranked rows}, for the prefixes of up to short_prefix characters"""
+        buckets = defaultdict(list)
+        for row in rows:
+            for prefix in self.prefixes(row[0]):
+                buckets[prefix].append(row)
+        return dict((prefix, heapq.nlargest(self.top_k, bucket, key=ranking)) for prefix, bucket in buckets.iteritems())
+
+    def prefixes(self, key):
+        return [key[:n] for n in range(1, min(len(key), self.short_prefix) + 1)]
+
+    def forget(self, changed, max_changed=100):
+        """Drop the memoized results of the prefixes of the changed keys, all of them for None"""
+        if changed is None or len(changed) > max_changed:
+            self.results.clear()
+            return
+        for key in self.results.keys():
+            if any(name.startswith(key[0]) for name in changed):
+                self.results.discard(key)
+
+    def update(self, ids):
+        """Reload the rows of the given place ids"""
+        ids = set(ids)
+        if not ids: return
+        fresh = []
+        ids_list = list(ids)
+        for start in range(0, len(ids_list), 1000):
+            chunk = ids_list[start:start + 1000]
+            fresh += self.select("AND id IN ({0})".format(", ".join(["%s"] * len(chunk))), chunk)
+        fresh.sort()
+
+        with self.write_lock:
+            if self.pending is not None:
+                self.pending.update(ids)
+            old = [self.by_id.pop(id) for id in ids if id in self.by_id]
+            self.by_id.update((row[2], row) for row in fresh)
+            # rows are unique (the id is in the tuple), bisect finds each one
+            gone = sorted(bisect_left(self.rows, row) for row in old)
+            changed = set(row[0] for row in old + fresh)
+            if len(gone) + len(fresh) > self.max_in_place:
+                rows = remove_positions(self.rows, gone)
+                keys = remove_positions(self.keys, gone)
+                at = [bisect_left(rows, row) for row in fresh]
+                rows = insert_positions(rows, at, fresh)
+                keys = insert_positions(keys, at, [row[0] for row in fresh])
+                tops = self.update_tops(rows, keys, ids, old, fresh)
+                with self.lock:
+                    self.rows, self.keys, self.tops = rows, keys, tops
+                    self.forget(changed)
+                return
+            with self.lock:
+                for i in reversed(gone):
+                    del self.rows[i]
+                    del self.keys[i]
+                for row in fresh:
+                    i = bisect_left(self.rows, row)
+                    self.rows.insert(i, row)
+                    self.keys.insert(i, row[0])
+                self.tops = self.update_tops(self.rows, self.keys, ids, old, fresh)
+                self.forget(changed)
+
+    def update_tops(self, rows, keys, ids, old, fresh):
+        """tops with the lists of the prefixes of the old and fresh rows of ids recomputed"""
+        tops = dict(self.tops)
+        prefixes = set()
+        for row in old:
+            prefixes.update(self.prefixes(row[0]))
+        added = defaultdict(list)
+        for row in fresh:
+            for prefix in self.prefixes(row[0]):
+                added[prefix].append(row)
+        prefixes.update(added)
+        for prefix in prefixes:
+            before = tops.get(prefix, [])
+            top = [row for row in before if row[2] not in ids]
+            if len(before) >= self.top_k and len(top) < len(before):
+                # a row of a full list left, the next best may be anywhere in the range
+                lo = bisect_left(keys, prefix)
+                hi = bisect_left(keys, prefix + u'\uffff', lo)
+                top = heapq.nlargest(self.top_k, rows[lo:hi], key=ranking)
+            else:
+                top = sorted(top + added.get(prefix, []), key=best_first)[:self.top_k]
+            if top:
+                tops[prefix] = top
+            else:
+                tops.pop(prefix, None)
+        return tops
+
+    def search(self, prefix, limit=10):
+        if self.max_age and time.time() - self.loaded > self.max_age:
+            self.reload_async()
+        key = (prefix, limit)
+        result = self.results.get(key)
+        if result is None:
+            with self.lock:
+                if len(prefix) <= self.short_prefix and limit <= self.top_k:
+                    best = self.tops.get(prefix, [])[:limit]
+                else:
+                    lo = bisect_left(self.keys, prefix)
+                    hi = bisect_left(self.keys, prefix + u'\uffff', lo)
+                    best = heapq.nlargest(limit, self.rows[lo:hi], key=ranking)
+                result = [row[2:] for row in best]
+                self.results.set(key, result)
+        return result
+
+    def reload_async(self):
+        """Reload the rows in a background thread, unless one is running"""
+        with self.lock:
+            if self.reloading: return
+            self.reloading = True
+        thread = threading.Thread(target=self.reload, name='cities-prefix-cache')
+        thread.daemon = True
+        thread.start()
+
+    def reload(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception("Reloading the autocomplete cache of {0} failed".format(self.table))
+            # try again after max_age, not on every search
+            self.loaded = time.time()
+        finally:
+            self.reloading = False
+            connections[self.using].close()
+
+def ranking(row):
+    return row[1]
+
+def best_first(row):
+    # the order of heapq.nlargest(key=ranking) over sorted rows: ranking, then name
+    return (-row[1], row)
+
+def remove_positions(seq, positions):
+    """Copy of seq without the items at the sorted positions"""
+    result, last = [], 0
+    for i in positions:
+        result.extend(seq[last:i])
+        last = i + 1
+    result.extend(seq[last:])
+    return result
+
+def insert_positions(seq, positions, items):
+    """Copy of seq with each item inserted before its position, positions sorted"""
+    result, last = [], 0
+    for i, item in zip(positions, items):
+        result.extend(seq[last:i])
+        result.append(item)
+        last = i
+    result.extend(seq[last:])
+    return result
@@ -0,0 +1,359 @@
+"""
+Batched writes for the GeoNames import.
+
+Place subclasses use multi-table inheritance, which Django's bulk_create
+does not support, so the parent rows (cities_place) and the child rows
+(cities_city, cities_region, ...) are inserted separately with one
+multi-row INSERT per table and batch.
+
+Rows already in the database are compared by geonames_hash, the checksum
+of the GeoNames line they were built from: unchanged rows are skipped and
+changed rows are written over the existing ones in one statement per
+table (INSERT ... ON CONFLICT DO UPDATE / ON DUPLICATE KEY UPDATE).
+"""
+
+import logging
+from itertools import islice
+from cStringIO import StringIO
+from collections import OrderedDict, defaultdict, Counter
+from django.db import connections, transaction, reset_queries, DatabaseError
+from django.db.models import AutoField
+from django.contrib.gis.db.models import GeometryField
+from django.utils.encoding import force_unicode
+from models import Place, AlternativeName
+from autocomplete import is_deferred, defer, subordinate_ids
+from stats import timed
+
+class BulkWriter(object):
+    """Queue model instances and m2m links and write them in batches"""
+
+    logger = logging.getLogger("cities")
+    # cities.stats.ImportStats timing the writes, if any
+    stats = None
+    # ids reserved in advance for this writer by another process, see reserve_ids
+    reserved = None
+
+    def __init__(self, batch_size=1000, using='default'):
+        self.batch_size = batch_size
+        self.using = using
+        self.pending = OrderedDict()
+        self.links = OrderedDict()
+        # model name -> inserted/updated/unchanged row counts
+        self.counts = defaultdict(Counter)
+
+    def add(self, obj):
+        """Queue obj to be saved, flushing its model once the batch is full"""
+        model = type(obj)
+        batch = self.pending.setdefault(model, [])
+        batch.append(obj)
+        if len(batch) >= self.batch_size:
+            self.flush_model(model)
+
+    def link(self, descriptor, source_id, target_id):
+        """Queue an m2m row, eg. link(Place.alt_names, place.id, alt.id)"""
+        field = descriptor.field
+        key = (field.rel.through, field.m2m_field_name(), field.m2m_reverse_field_name())
+        batch = self.links.setdefault(key, [])
+        batch.append((source_id, target_id))
+        if len(batch) >= self.batch_size:
+            # both ends of the link must exist before the link itself
+            self.flush()
+
+    def flush(self):
+        for model in self.pending.keys():
+            self.flush_model(model)
+        for key in self.links.keys():
+            self.flush_links(key)
+
+    def flush_model(self, model):
+        objs = self.pending.pop(model, [])
+        if not objs: return
+        with timed(self.stats, 'db'):
+            self._flush_model(model, objs)
+
+    def _flush_model(self, model, objs):
+        counts = self.counts[model.__name__].copy()
+        try:
+            with transaction.commit_on_success(using=self.using):
+                self._write(model, objs)
+        except DatabaseError as e:
+            # a single bad row fails the whole INSERT, retry the batch row by row;
+            # new rows are inserted, save() of a model may expect the row to exist
+            self.logger.warning("Batch of {0} {1} failed, writing one by one: {2}".format(len(objs), model.__name__, e))
+            self.counts[model.__name__] = counts
+            for obj in objs:
+                counts = self.counts[model.__name__].copy()
+                try:
+                    with transaction.commit_on_success(using=self.using):
+                        self._write(model, [obj])
+                except DatabaseError as e:
+                    counts['failed'] += 1
+                    self.counts[model.__name__] = counts
+                    self.logger.error("{0} {1}: {2}".format(model.__name__, obj.pk, e))
+        # free some memory
+        # https://docs.djangoproject.com/en/dev/faq/models/
+        reset_queries()
+
+    def _write(self, model, objs):
+        if issubclass(model, Place) and model is not Place:
+            self._write_places(model, objs)
+        else:
+            self._write_models(model, objs)
+
+    def save(self, obj):
+        if hasattr(obj, 'geonames'):
+            # keep the provenance set by the importer
+            obj.save(using=self.using, geonames=obj.geonames)
+        else:
+            obj.save(using=self.using)
+
+    def flush_links(self, key):
+        rows = self.links.pop(key, [])
+        if not rows: return
+        with timed(self.stats, 'db'):
+            self._flush_links(key, rows)
+
+    def _flush_links(self, key, rows):
+        through, source_name, target_name = key
+        source = through._meta.get_field(source_name).attname
+        target = through._meta.get_field(target_name).attname
+
+        with transaction.commit_on_success(using=self.using):
+            existing = set(through.objects.using(self.using).filter(**{
+                target + '__in': set(t for s, t in rows)
+            }).values_list(source, target))
+            new = []
+            for row in rows:
+                if row in existing: continue
+                existing.add(row)
+                new.append(through(**{source: row[0], target: row[1]}))
+            if new:
+                self._insert_models(through, new)
+        reset_queries()
+
+    def report(self):
+        """Take the row counts written since the last report"""
+        counts, self.counts = self.counts, defaultdict(Counter)
+        return counts
+
+    def _split_existing(self, model, objs, pk_name):
+        """
+        Split objs into new and changed rows, dropping the rows whose
+        geonames_hash did not change. Also returns the stored rows by pk.
+        """
+        base = Place if issubclass(model, Place) else model
+        hashed = has_hash(base)
+        ids = [getattr(obj, pk_name) for obj in objs if getattr(obj, pk_name) is not None]
+        stored = {}
+        if ids:
+            fields = ['pk']
+            if hashed: fields.append('geonames_hash')
+            if base is Place: fields += ['name', 'ancestor_ids', 'slug_path']
+            for row in base.objects.using(self.using).filter(pk__in=ids).values(*fields):
+                stored[row['pk']] = row
+        new, changed = [], []
+        counts = self.counts[model.__name__]
+        for obj in objs:
+            row = stored.get(getattr(obj, pk_name))
+            if row is None:
+                new.append(obj)
+            elif hashed and obj.geonames_hash and obj.geonames_hash == row['geonames_hash']:
+                counts['unchanged'] += 1
+            else:
+                changed.append(obj)
+        counts['inserted'] += len(new)
+        counts['updated'] += len(changed)
+        return new, changed, stored
+
+    def _write_models(self, model, objs):
+        new, changed, stored = self._split_existing(model, objs, model._meta.pk.attname)
+        if changed and has_hash(model):
+            self.upsert(model, changed)
+            if model is AlternativeName and is_deferred():
+                # the translated names of the linked places changed
+                defer(Place.alt_names.through.objects.using(self.using).filter(
+                    alternativename__in=[obj.pk for obj in changed]
+                ).values_list('place', flat=True))
+        else:
+            # models without a hash keep the regular save() path
+            for obj in changed:
+                self.save(obj)
+        if new:
+            self._insert_models(model, new)
+
+    def _insert_models(self, model, objs):
+        model.objects.using(self.using).bulk_create(objs)
+
+    def _write_places(self, model, objs):
+        new, changed, stored = self._split_existing(model, objs, 'id')
+        if changed:
+            self._update_places(model, changed, stored)
+        if not new: return
+
+        missing = [obj for obj in new if obj.id is None]
+        for obj, id in zip(missing, self.reserve_ids(len(missing))):
+            obj.id = id
+
+        for obj in new:
+            setattr(obj, model._meta.pk.attname, obj.id)
+            obj.place_type = model._meta.module_name
+            obj.build_path()
+        self._insert_places(model, new)
+        if is_deferred():
+            defer([obj.id for obj in new])
+
+    def _update_places(self, model, objs, stored):
+        for obj in objs:
+            setattr(obj, model._meta.pk.attname, obj.id)
+            obj.place_type = model._meta.module_name
+            obj.build_path()
+        self.upsert(Place, objs)
+        self.upsert(model, objs)
+        for obj in objs:
+            # the descendants keep the path of this place
+            old = stored[obj.id]
+            if old['ancestor_ids'] and (old['ancestor_ids'], old['slug_path']) != (obj.ancestor_ids, obj.slug_path):
+                obj.update_descendant_paths(old['ancestor_ids'], old['slug_path'])
+            # and repeat its name and URL in their autocomplete rows
+            if is_deferred() and (old['name'], old['slug_path']) != (obj.name, obj.slug_path):
+                defer(subordinate_ids(obj))
+        if is_deferred():
+            defer([obj.id for obj in objs])
+
+    def upsert(self, model, objs):
+        """
+        Write the local fields of objs over their rows of model's table, in
+        one statement on PostgreSQL (9.5+) and MySQL, row by row otherwise.
+        """
+        connection = connections[self.using]
+        fields = model._meta.local_fields
+        pk = model._meta.pk
+        if connection.vendor not in ('postgresql', 'mysql'):
+            for obj in objs:
+                model._base_manager.using(self.using).filter(pk=getattr(obj, pk.attname)).update(**dict(
+                    (field.name, getattr(obj, field.attname)) for field in fields if field is not pk
+                ))
+            return
+
+        qn = connection.ops.quote_name
+        rows, params = [], []
+        for obj in objs:
+            placeholders = []
+            for field in fields:
+                value = field.get_db_prep_save(getattr(obj, field.attname), connection=connection)
+                # geometries are wrapped in a conversion function, see SQLInsertCompiler.placeholder
+                if hasattr(field, 'get_placeholder'):
+                    placeholders.append(field.get_placeholder(value, connection))
+                else:
+                    placeholders.append('%s')
+                params.append(value)
+            rows.append("(" + ", ".join(placeholders) + ")")
+
+        columns = [qn(field.column) for field in fields]
+        updated = [qn(field.column) for field in fields if field is not pk]
+        if connection.vendor == 'postgresql':
+            conflict = "ON CONFLICT ({0}) DO UPDATE SET {1}".format(
+                qn(pk.column), ", ".join(["{0} = EXCLUDED.{0}".format(column) for column in updated]))
+        else:
+            conflict = "ON DUPLICATE KEY UPDATE " + ", ".join(["{0} = VALUES({0})".format(column) for column in updated])
+        sql = "INSERT INTO {0} ({1}) VALUES {2} {3}".format(
+            qn(model._meta.db_table), ", ".join(columns), ", ".join(rows), conflict)
+        connection.cursor().execute(sql, params)
+
+    def _insert_places(self, model, objs):
+        parents = []
+        for obj in objs:
+            parent = Place()
+            for field in Place._meta.local_fields:
+                setattr(parent, field.attname, getattr(obj, field.attname))
+            parents.append(parent)
+        Place.objects.using(self.using).bulk_create(parents)
+        model._base_manager._insert(objs, fields=model._meta.local_fields, using=self.using)
+
+    def has_sequence(self):
+        """Whether reserve_ids() is safe when several processes insert places at once"""
+        return connections[self.using].vendor == 'postgresql'
+
+    def reserve_ids(self, count):
+        """Allocate count ids for new places (postal codes have no geonameid)"""
+        if not count: return []
+        if self.reserved is not None:
+            ids = list(islice(self.reserved, count))
+            if len(ids) < count:
+                raise ValueError("The ids reserved for this writer are exhausted")
+            return ids
+        connection = connections[self.using]
+        cursor = connection.cursor()
+        table = Place._meta.db_table
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [table, count])
+            return [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT MAX(id) FROM %s" % connection.ops.quote_name(table))
+        start = (cursor.fetchone()[0] or 0) + 1
+        return range(start, start + count)
+
+
+class CopyWriter(BulkWriter):
+    """
+    BulkWriter for PostgreSQL that streams new rows with COPY ... FROM STDIN
+    instead of INSERT. Geometries must already be set as (E)WKB hex strings,
+    see cities.util.ewkb_point, so they are written without being parsed.
+    """
+
+    def __init__(self, batch_size=10000, using='default'):
+        super(CopyWriter, self).__init__(batch_size, using)
+        if connections[using].vendor != 'postgresql':
+            raise ValueError("The copy engine requires a PostgreSQL database")
+
+    def _insert_models(self, model, objs):
+        # like bulk_create, auto ids that are not set are left to the sequence
+        fields = model._meta.local_fields
+        with_pk = [obj for obj in objs if obj.pk is not None]
+        without_pk = [obj for obj in objs if obj.pk is None]
+        if with_pk:
+            self.copy(model, fields, with_pk)
+        if without_pk:
+            self.copy(model, [field for field in fields if not isinstance(field, AutoField)], without_pk)
+
+    def _insert_places(self, model, objs):
+        self.copy(Place, Place._meta.local_fields, objs)
+        self.copy(model, model._meta.local_fields, objs)
+
+    def copy(self, model, fields, objs):
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        buf = StringIO()
+        for obj in objs:
+            buf.write("\t".join([copy_value(obj, field) for field in fields]))
+            buf.write("\n")
+        buf.seek(0)
+        sql = "COPY {0} ({1}) FROM STDIN".format(
+            qn(model._meta.db_table),
+            ", ".join([qn(field.column) for field in fields]),
+        )
+        cursor = connection.cursor()
+        cursor.copy_expert(sql, buf)
+
+def has_hash(model):
+    return 'geonames_hash' in [field.name for field in model._meta.fields]
+
+# backslash first, the other escapes introduce new ones
+copy_escapes = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]
+
+def copy_value(obj, field):
+    """Format a field of obj in the COPY text format"""
+    if isinstance(field, GeometryField):
+        # read the raw value, the descriptor would build a GEOS geometry
+        value = obj.__dict__.get(field.attname)
+        if value is not None and not isinstance(value, basestring):
+            value = value.hexewkb
+    else:
+        value = field.get_prep_value(getattr(obj, field.attname))
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    value = force_unicode(value).encode('utf-8')
+    for char, escaped in copy_escapes:
+        value = value.replace(char, escaped)
+    return value
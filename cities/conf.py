@@ -38,7 +38,9 @@ files = {
             'geonameid',
             'neighbours',
             'equivalentFips'
-        ]
+        ],
+        # numeric columns, parsed once by cities.reader.Reader
+        'types': {'area': float, 'population': int, 'geonameid': int}
     },
     'region':       {
         'filename': 'admin1CodesASCII.txt',
@@ -48,7 +50,8 @@ files = {
             'name',
             'asciiName',
             'geonameid',
-        ]
+        ],
+        'types': {'geonameid': int}
     },
     'subregion':    {
         'filename': 'admin2Codes.txt',
@@ -58,7 +61,8 @@ files = {
             'name',
             'asciiName',
             'geonameid',
-        ]
+        ],
+        'types': {'geonameid': int}
     },
     'city':         {
         'filename': 'cities5000.zip',
@@ -83,7 +87,8 @@ files = {
             'gtopo30',
             'timezone',
             'modificationDate'
-        ]
+        ],
+        'types': {'geonameid': int, 'latitude': float, 'longitude': float, 'population': int, 'elevation': int, 'gtopo30': int}
     },
     'hierarchy':    {
         'filename': 'hierarchy.zip',
@@ -91,7 +96,8 @@ files = {
         'fields': [
             'parent',
             'child'
-        ]
+        ],
+        'types': {'parent': int, 'child': int}
     },
     'alt_name':     {
         'filename': 'alternateNames.zip',
@@ -105,7 +111,39 @@ files = {
             'isShort',
             'isColloquial',
             'isHistoric',
-        ]
+        ],
+        'types': {'nameid': int, 'geonameid': int}
+    },
+    # Daily changes, {date} is YYYY-MM-DD. See --incremental
+    'modifications': {
+        'filename': 'modifications-{date}.txt',
+        'urls':     [url_bases['geonames']['dump']+'{filename}', ],
+        'fields':   'city',
+    },
+    'deletes':      {
+        'filename': 'deletes-{date}.txt',
+        'urls':     [url_bases['geonames']['dump']+'{filename}', ],
+        'fields': [
+            'geonameid',
+            'name',
+            'comment',
+        ],
+        'types': {'geonameid': int}
+    },
+    'alt_name_modifications': {
+        'filename': 'alternateNamesModifications-{date}.txt',
+        'urls':     [url_bases['geonames']['dump']+'{filename}', ],
+        'fields':   'alt_name',
+    },
+    'alt_name_deletes': {
+        'filename': 'alternateNamesDeletes-{date}.txt',
+        'urls':     [url_bases['geonames']['dump']+'{filename}', ],
+        'fields': [
+            'nameid',
+            'geonameid',
+            'comment',
+        ],
+        'types': {'nameid': int, 'geonameid': int}
     },
     'postal_code':  {
         'filename': 'allCountries.zip',
@@ -123,7 +161,8 @@ files = {
             'latitude',
             'longitude',
             'accuracy',
-        ]
+        ],
+        'types': {'latitude': float, 'longitude': float, 'accuracy': int}
     }
 }
 
@@ -183,6 +222,14 @@ plugin_hooks = [
     'postal_code_pre',  'postal_code_post',
 ]
 
+# Hook functions called with lists of rows, before the row hooks
+plugin_batch_hooks = [
+    'country_pre_batch',    'region_pre_batch',
+    'subregion_pre_batch',  'city_pre_batch',
+    'district_pre_batch',   'alt_name_pre_batch',
+    'postal_code_pre_batch',
+]
+
 def create_settings():
     res = type('',(),{})
     
@@ -191,6 +238,12 @@ def create_settings():
         for key in django_settings.CITIES_FILES.keys():
             res.files[key].update(django_settings.CITIES_FILES[key])
 
+    # files in the same format as another one share its columns
+    for key, value in res.files.items():
+        if isinstance(value['fields'], basestring):
+            base = res.files[value['fields']]
+            res.files[key] = dict(value, fields=base['fields'], types=base.get('types'))
+
     if hasattr(django_settings, "CITIES_LOCALES"):
         locales = django_settings.CITIES_LOCALES[:]
     else:
@@ -206,6 +259,32 @@ def create_settings():
         res.postal_codes = set([e.upper() for e in django_settings.CITIES_POSTAL_CODES])
     else:
         res.postal_codes = set()
+
+    # Number of rows written per INSERT during the import
+    res.batch_size = getattr(django_settings, "CITIES_IMPORT_BATCH_SIZE", 1000)
+
+    # Languages with a cities_table_autocomplete_<language> table
+    res.autocomplete_languages = getattr(django_settings, "CITIES_AUTOCOMPLETE_LANGUAGES", ['pt', 'en'])
+
+    # Answer cities.autocomplete.search() from memory, reloading the rows every CITIES_AUTOCOMPLETE_CACHE_AGE seconds
+    res.autocomplete_cache = getattr(django_settings, "CITIES_AUTOCOMPLETE_CACHE", False)
+    res.autocomplete_cache_age = getattr(django_settings, "CITIES_AUTOCOMPLETE_CACHE_AGE", 300)
+
+    # Rewrite the autocomplete rows of the descendants of a renamed place in a background thread
+    res.autocomplete_async = getattr(django_settings, "CITIES_AUTOCOMPLETE_ASYNC", False)
+
+    # Translated names kept in memory per language and their age in seconds, see cities.models.translate_many
+    res.translation_cache_size = getattr(django_settings, "CITIES_TRANSLATION_CACHE_SIZE", 10000)
+    res.translation_cache_age = getattr(django_settings, "CITIES_TRANSLATION_CACHE_AGE", 300)
+
+    # Places and lookups kept per request by cities.memo
+    res.request_memo_size = getattr(django_settings, "CITIES_REQUEST_MEMO_SIZE", 1000)
+
+    # Cache alias shared by the processes for translated names and URLs, see cities.placecache
+    res.cache = getattr(django_settings, "CITIES_CACHE", None)
+    res.cache_timeout = getattr(django_settings, "CITIES_CACHE_TIMEOUT", 86400)
+    res.cache_languages = set([e[:2] for e in res.autocomplete_languages] +
+                              [e[0][:2] for e in getattr(django_settings, "LANGUAGES", [])])
     
     return res
 
@@ -216,7 +295,7 @@ def create_plugins():
         module = import_module(module_path)
         class_ = getattr(module,classname)
         obj = class_()
-        [settings.plugins[hook].append(obj) for hook in plugin_hooks if hasattr(obj,hook)]
+        [settings.plugins[hook].append(obj) for hook in plugin_hooks + plugin_batch_hooks if hasattr(obj,hook)]
         
 settings = create_settings()
 if hasattr(django_settings, "CITIES_PLUGINS"):
@@ -0,0 +1,166 @@
+"""
+Streaming download of the GeoNames files.
+
+Files are written in chunks to <filename>.part and renamed into place once
+complete, so an interrupted download never leaves a truncated file behind
+and can be resumed with an HTTP Range request. A sidecar manifest
+(<filename>.json) keeps the validators (ETag, Last-Modified), size and
+sha256 of the downloaded file for the next conditional request.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import urllib2
+from email.utils import formatdate
+
+class DownloadError(Exception): pass
+
+class Downloader(object):
+    chunk_size = 64 * 1024
+    logger = logging.getLogger("cities")
+
+    def __init__(self, data_dir, timeout=60):
+        self.data_dir = data_dir
+        self.timeout = timeout
+
+    def download(self, urls, filename):
+        """
+        Fetch filename from the first url that answers, returns True if the
+        local copy was already up-to-date.
+        """
+        filepath = os.path.join(self.data_dir, filename)
+        for url in urls:
+            try:
+                return self.fetch(url, filepath)
+            except (urllib2.URLError, DownloadError, IOError) as e:
+                self.logger.warning("Download failed: {0}: {1}".format(url, e))
+                continue
+        self.logger.error("Web file not found: {0}. Tried URLs:\n{1}".format(filename, '\n'.join(urls)))
+        if not os.path.exists(filepath):
+            raise Exception("File not found and download failed: " + filename)
+        self.logger.warning("Assuming file is up-to-date")
+        return True
+
+    def fetch(self, url, filepath):
+        filename = os.path.basename(filepath)
+        manifest = self.read_manifest(filepath)
+        headers = {}
+        complete = self.is_complete(filepath, manifest, url)
+        if complete:
+            if manifest.get('etag'):
+                headers['If-None-Match'] = manifest['etag']
+            if manifest.get('last_modified'):
+                headers['If-Modified-Since'] = manifest['last_modified']
+        elif os.path.exists(filepath) and not manifest:
+            # file from before the manifests existed
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(filepath), usegmt=True)
+
+        partpath = filepath + '.part'
+        part = self.read_manifest(partpath)
+        offset = 0
+        if os.path.exists(partpath) and part.get('url') == url and (part.get('etag') or part.get('last_modified')):
+            offset = os.path.getsize(partpath)
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            headers['If-Range'] = part.get('etag') or part.get('last_modified')
+
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                self.logger.info("File up-to-date: " + filename)
+                return True
+            if e.code == 416:
+                # the partial file is no longer valid
+                self.remove(partpath)
+                self.remove(self.manifest_path(partpath))
+            raise
+
+        info = response.info()
+        if 'html' in (info.getheader('content-type') or ''):
+            raise DownloadError("Got an HTML page")
+        validators = {
+            'url': url,
+            'etag': info.getheader('etag'),
+            'last_modified': info.getheader('last-modified'),
+        }
+        if response.getcode() != 206:
+            offset = 0
+        length = info.getheader('content-length')
+        size = offset + int(length) if length is not None else None
+
+        if complete and size is not None and size == manifest.get('size') \
+                and (validators['etag'], validators['last_modified']) == (manifest.get('etag'), manifest.get('last_modified')) \
+                and (validators['etag'] or validators['last_modified']):
+            # the server ignored the conditional request
+            response.close()
+            self.logger.info("File up-to-date: " + filename)
+            return True
+
+        self.logger.info("Downloading: {0}{1}".format(filename, " (resuming at {0} bytes)".format(offset) if offset else ""))
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+        self.write_manifest(partpath, validators)
+
+        sha256 = hashlib.sha256()
+        if offset:
+            with open(partpath, 'rb') as file:
+                for chunk in iter(lambda: file.read(self.chunk_size), ''):
+                    sha256.update(chunk)
+        with open(partpath, 'ab' if offset else 'wb') as file:
+            for chunk in iter(lambda: response.read(self.chunk_size), ''):
+                file.write(chunk)
+                sha256.update(chunk)
+        response.close()
+
+        written = os.path.getsize(partpath)
+        if size is not None and written != size:
+            raise DownloadError("Incomplete download: {0} of {1} bytes".format(written, size))
+
+        os.rename(partpath, filepath)
+        validators.update(size=written, sha256=sha256.hexdigest(), downloaded=time.time())
+        self.write_manifest(filepath, validators)
+        self.remove(self.manifest_path(partpath))
+        return False
+
+    def is_complete(self, filepath, manifest, url):
+        """Whether filepath is the whole file downloaded from url, checked against its sha256"""
+        if not (os.path.exists(filepath) and manifest.get('url') == url
+                and manifest.get('size') == os.path.getsize(filepath)):
+            return False
+        if manifest.get('sha256') and not self.verify(filepath):
+            self.logger.warning("Checksum mismatch, downloading again: " + os.path.basename(filepath))
+            return False
+        return True
+
+    def verify(self, filepath):
+        """Check the file against the sha256 of its manifest"""
+        manifest = self.read_manifest(filepath)
+        if not manifest.get('sha256') or not os.path.exists(filepath): return False
+        sha256 = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), ''):
+                sha256.update(chunk)
+        return sha256.hexdigest() == manifest['sha256']
+
+    def manifest_path(self, filepath):
+        return filepath + '.json'
+
+    def read_manifest(self, filepath):
+        try:
+            with open(self.manifest_path(filepath)) as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def write_manifest(self, filepath, manifest):
+        path = self.manifest_path(filepath)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(manifest, file)
+        os.rename(path + '.tmp', path)
+
+    def remove(self, path):
+        try: os.remove(path)
+        except OSError: pass
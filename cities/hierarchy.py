@@ -0,0 +1,167 @@
+"""
+Compact parent/child index of the GeoNames hierarchy file.
+
+Each (child, parent) pair is packed into one 64 bit integer and kept in
+two sorted arrays, one keyed by child and one by parent, so the index
+costs 16 bytes per pair instead of the boxed ints and hash slots of a
+dict, and both lookups are a binary search. Ids must fit in 31 bits,
+GeoNames ids are far below that. Where a C long has only 32 bits (eg.
+Windows) the pairs are kept in two parallel arrays instead.
+
+Run as a script to compare it with a dict over the whole file:
+
+    python -m cities.hierarchy cities/data/hierarchy.zip
+"""
+
+import sys
+import time
+import random
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+shift = 32
+mask = (1 << shift) - 1
+max_id = 1 << 31
+# a (child, parent) pair fits in one C long only where it has 64 bits, not eg. on Windows
+wide = array('l').itemsize >= 8
+
+class HierarchyIndex(object):
+
+    def __init__(self, pairs):
+        """Build from an iterable of (child, parent) pairs, streamed"""
+        if wide:
+            by_child, by_parent = array('l'), array('l')
+        else:
+            by_child, by_parent = [], []
+        for child, parent in pairs:
+            if child is None or parent is None: continue
+            if not 0 <= child < max_id or not 0 <= parent < max_id:
+                raise ValueError("Id out of range: {0}, {1}".format(child, parent))
+            if wide:
+                by_child.append(child << shift | parent)
+                by_parent.append(parent << shift | child)
+            else:
+                by_child.append((child, parent))
+                by_parent.append((parent, child))
+        pairs_class = PackedPairs if wide else SplitPairs
+        self.by_child = pairs_class(by_child)
+        self.by_parent = pairs_class(by_parent)
+
+    def __len__(self):
+        return len(self.by_child)
+
+    @property
+    def nbytes(self):
+        return self.by_child.nbytes + self.by_parent.nbytes
+
+    def parent(self, child, default=None):
+        return self.by_child.first(child, default)
+
+    def get(self, child, default=None):
+        """dict-like alias of parent(), child may be None"""
+        if child is None: return default
+        return self.parent(child, default)
+
+    def children(self, parent):
+        """Ids of the children of parent, in id order"""
+        return self.by_parent.values(parent)
+
+class PackedPairs(object):
+    """(key, value) pairs packed as key << 32 | value in one sorted array of 64 bit longs"""
+
+    def __init__(self, keys):
+        self.keys = sort(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return len(self.keys) * self.keys.itemsize
+
+    def first(self, key, default=None):
+        keys = self.keys
+        i = bisect_left(keys, key << shift)
+        if i < len(keys) and keys[i] >> shift == key:
+            return keys[i] & mask
+        return default
+
+    def values(self, key):
+        keys = self.keys
+        i = bisect_left(keys, key << shift)
+        j = bisect_left(keys, (key + 1) << shift, i)
+        return [keys[k] & mask for k in xrange(i, j)]
+
+class SplitPairs(object):
+    """The same pairs as two parallel sorted arrays, where a C long has 32 bits"""
+
+    def __init__(self, pairs):
+        pairs.sort()
+        self.keys = array('l', [key for key, value in pairs])
+        self.items = array('l', [value for key, value in pairs])
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return (len(self.keys) + len(self.items)) * self.keys.itemsize
+
+    def first(self, key, default=None):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.items[i]
+        return default
+
+    def values(self, key):
+        i = bisect_left(self.keys, key)
+        j = bisect_left(self.keys, key + 1, i)
+        return list(self.items[i:j])
+
+def sort(keys):
+    """Sorted copy of an array('l') of keys, without boxing them when numpy is available"""
+    if numpy is not None:
+        result = array(keys.typecode)
+        result.fromstring(numpy.sort(numpy.frombuffer(keys, dtype=numpy.dtype(keys.typecode))).tostring())
+        return result
+    return array(keys.typecode, sorted(keys))
+
+def benchmark(path, lookups=100000):
+    """Memory and lookup time of a dict and of HierarchyIndex over the file"""
+    from cities.reader import Reader, open_data
+
+    def pairs():
+        with open_data(path) as file:
+            for row in Reader(['parent', 'child'], {'parent': int, 'child': int}).read(file):
+                yield row['child'], row['parent']
+
+    start = time.time()
+    mapping = dict(pairs())
+    dict_time = time.time() - start
+    dict_bytes = sys.getsizeof(mapping) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in mapping.iteritems())
+
+    start = time.time()
+    index = HierarchyIndex(pairs())
+    index_time = time.time() - start
+
+    ids = random.sample(list(mapping), min(lookups, len(mapping)))
+    results = []
+    for name, get in [('dict', mapping.get), ('index', index.parent)]:
+        start = time.time()
+        for id in ids:
+            get(id)
+        results.append((name, (time.time() - start) / len(ids) * 1e6))
+
+    print("{0} pairs".format(len(index)))
+    print("dict     build {0:.2f}s  {1:.1f} MB".format(dict_time, dict_bytes / 1048576.0))
+    print("index    build {0:.2f}s  {1:.1f} MB".format(index_time, index.nbytes / 1048576.0))
+    for name, us in results:
+        print("{0:8} lookup {1:.2f}us".format(name, us))
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
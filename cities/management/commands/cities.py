@@ -14,23 +14,54 @@ http://download.geonames.org/export/zip/
 - Postal Codes:         allCountries.zip
 """
 
+import io
 import os
-import sys
-import urllib
 import logging
-import zipfile
-import time
-from itertools import chain
+import json
+import traceback
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from zlib import crc32
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import chain, islice
 from optparse import make_option
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.template.defaultfilters import slugify
-from django.db import connection
-from django.contrib.gis.gdal.envelope import Envelope
+from django.db import connections
 from ...conf import *
 from ...models import *
-from ...util import geo_distance
-
-from django.db import transaction, reset_queries
+from ...models import set_place_types, set_place_paths, get_places, forget_translations
+from ...util import ewkb_point, keyset, PointGrid
+from ...bulk import BulkWriter, CopyWriter
+from ...download import Downloader
+from ...reader import Reader, open_data
+from ...hierarchy import HierarchyIndex
+from ...stats import ImportStats, Stage
+from ...autocomplete import deferred_autocomplete, is_deferred, defer, take_deferred, subordinate_ids
+
+# country code of a row, for the plugins declaring the countries they handle
+row_country = {
+    'country':      lambda item: item['code'],
+    'region':       lambda item: item['code'].split('.', 1)[0],
+    'subregion':    lambda item: item['code'].split('.', 1)[0],
+    'city':         lambda item: item['countryCode'],
+    'district':     lambda item: item['countryCode'],
+    'alt_name':     None,
+    'postal_code':  lambda item: item['countryCode'],
+}
+
+def plugin_countries(plugin):
+    """Country codes declared by plugin.countries, None for all countries"""
+    countries = getattr(plugin, 'countries', None)
+    return None if countries is None else set(countries)
+
+# command running a sharded import, inherited by the forked workers
+_command = None
+
+def run_shard(job):
+    return _command.run_shard(*job)
 
 class Command(BaseCommand):
     app_dir = os.path.normpath(os.path.dirname(os.path.realpath(__file__)) + '/../..')
@@ -48,6 +79,31 @@ class Command(BaseCommand):
         make_option('--flush', metavar="DATA_TYPES", default='',
             help =  "Selectively flush data. Comma separated list of data types."
         ),
+        make_option('--batch-size', metavar="ROWS", type='int', default=settings.batch_size,
+            help =  "Number of rows written per INSERT."
+        ),
+        make_option('--incremental', action='store_true', default=False,
+            help =  "Apply the GeoNames daily modification and deletion files published since the last run."
+        ),
+        make_option('--since', metavar="YYYY-MM-DD", default=None,
+            help =  "First day applied by --incremental, instead of the day after the last run."
+        ),
+        make_option('--workers', metavar="N", type='int', default=1,
+            help =  "Import cities and postal codes with N processes, each one a share of the countries."
+        ),
+        make_option('--report', metavar="PATH", default=None,
+            help =  "Write the per-stage metrics (rows, skips, queries, timings, peak RSS) to a JSON file."
+        ),
+        make_option('--progress', metavar="SECONDS", type='float', default=None,
+            help =  "Log the rows read and the throughput every SECONDS."
+        ),
+        make_option('--profile', metavar="DIR", default=None,
+            help =  "Profile each stage with cProfile into DIR/<stage>.prof."
+        ),
+        make_option('--engine', type='choice', choices=['bulk', 'copy'], default='bulk',
+            help =  "How rows are written: 'bulk' (multi-row INSERT) or 'copy' "
+                    "(PostgreSQL COPY FROM STDIN, fastest on empty tables)."
+        ),
     )
 
     def handle(self, *args, **options):
@@ -55,6 +111,13 @@ class Command(BaseCommand):
         self.options = options
 
         self.force = self.options['force']
+        self.workers = self.options['workers']
+        if self.options['engine'] == 'copy':
+            try: self.writer = CopyWriter(batch_size=self.options['batch_size'])
+            except ValueError as e: raise CommandError(str(e))
+        else:
+            self.writer = BulkWriter(batch_size=self.options['batch_size'])
+        self.stats = self.writer.stats = ImportStats(self.options['progress'], self.options['profile'])
 
         self.flushes = [e for e in self.options['flush'].split(',') if e]
         if 'all' in self.flushes: self.flushes = import_opts_all
@@ -65,88 +128,258 @@ class Command(BaseCommand):
         self.imports = [e for e in self.options['import'].split(',') if e]
         if 'all' in self.imports: self.imports = import_opts_all
         if self.flushes: self.imports = []
-        for import_ in self.imports:
-            func = getattr(self, "import_" + import_)
-            func()
-
-    def call_hook(self, hook, *args, **kwargs):
-        if hasattr(settings, 'plugins'):
-            for plugin in settings.plugins[hook]:
-                try:
-                    func = getattr(plugin,hook)
-                    func(self, *args, **kwargs)
-                except HookException as e:
-                    error = str(e)
-                    if error: self.logger.error(error)
-                    return False
-        return True
-
-    def download(self, filekey):
-        filename = settings.files[filekey]['filename']
-        web_file = None
+        if self.options['incremental']: self.imports = ['incremental']
+        # refresh the autocomplete tables once, after all imports
+        with deferred_autocomplete():
+            for import_ in self.imports:
+                func = getattr(self, "import_" + import_)
+                with self.stats.stage(import_):
+                    func()
+                    self.writer.flush()
+                self.report(import_)
+
+        # places saved before place_type and the materialized paths existed
+        with self.stats.stage('paths'):
+            set_place_types()
+            set_place_paths()
+
+        if self.options['report']:
+            self.stats.write(self.options['report'])
+
+    def report(self, import_):
+        """Log the rows written and the metrics of an import"""
+        stage = self.stats.stages[import_]
+        for model, counts in sorted(self.writer.report().items()):
+            stage.written[model] = counts
+            self.logger.info("{0}: {1}: {2} inserted, {3} updated, {4} unchanged, {5} failed".format(
+                import_, model, counts['inserted'], counts['updated'], counts['unchanged'], counts['failed']))
+        self.logger.info("{0}: {1} rows read, {2} skipped, {3} queries, {4:.1f}s ({5}), peak RSS {6} MB".format(
+            import_, sum(stage.read.values()), sum(stage.skipped.values()), stage.queries, stage.elapsed,
+            ", ".join(["{0} {1:.1f}s".format(key, value) for key, value in sorted(stage.times.items())]),
+            stage.peak_rss_kb // 1024))
+        if stage.skipped:
+            self.logger.info("{0}: skipped: {1}".format(
+                import_, ", ".join(["{0} {1}".format(key, value) for key, value in sorted(stage.skipped.items())])))
+
+    def shard_of(self, country_code):
+        return (crc32(country_code.encode('utf-8')) & 0xffffffff) % self.workers
+
+    def import_sharded(self, func, filekey):
+        """
+        Run func(data) over the rows of filekey. With --workers the lines are
+        split by country code into one file per shard and processed by a pool
+        of forked workers, which share the indexes built so far.
+        """
+        if self.workers <= 1:
+            func(self.get_data(filekey))
+            return
+
+        with self.stats.timer('split'):
+            paths, counts = self.split_shards(filekey)
+        first_ids = [None] * self.workers
+        if not self.writer.has_sequence():
+            # MAX(id) + 1 would give every worker the same ids, each shard gets its own range
+            start = self.writer.reserve_ids(1)[0]
+            for shard, count in enumerate(counts):
+                first_ids[shard] = start
+                start += count
+
+        global _command
+        _command = self
+        # every worker opens its own connection
+        for conn in connections.all():
+            conn.close()
+        pool = Pool(self.workers)
+        try:
+            results = pool.map(run_shard, [(func.__name__, filekey, shard, paths[shard], first_ids[shard], counts[shard])
+                                           for shard in range(self.workers)])
+        finally:
+            pool.close()
+            pool.join()
+            _command = None
+            for path in paths:
+                os.remove(path)
+
+        failed = []
+        for result in results:
+            if is_deferred(): defer(result['deferred'])
+            for model, counts in result['counts'].items():
+                self.writer.counts[model].update(counts)
+            self.stats.current.merge(result['stats'])
+            self.logger.info("{0} shard {1}: {2} rows, countries: {3}".format(
+                filekey, result['shard'], result['rows'], ",".join(result['countries'])))
+            if result['error']:
+                self.logger.error("{0} shard {1} failed:\n{2}".format(filekey, result['shard'], result['error']))
+                failed.append(str(result['shard']))
+        if failed:
+            raise CommandError("Import of {0} failed in shards: {1}".format(filekey, ", ".join(failed)))
+
+    def split_shards(self, filekey):
+        """
+        Copy the lines of filekey into <file>.shard<N>, by the shard of their
+        country code, so each worker parses only its own rows. Returns the
+        paths and the line count of every shard.
+        """
+        filepath = os.path.join(self.data_dir, settings.files[filekey]['filename'])
+        column = settings.files[filekey]['fields'].index('countryCode')
+        paths = ["{0}.shard{1}".format(filepath, shard) for shard in range(self.workers)]
+        counts = [0] * self.workers
+        files = [io.open(path, 'w', encoding='utf-8') for path in paths]
+        try:
+            with open_data(filepath) as lines:
+                for line in lines:
+                    if line[:1] == '#' or not line.strip(): continue
+                    values = line.split('\t', column + 1)
+                    # malformed lines go to shard 0, whose reader rejects them
+                    shard = self.shard_of(values[column]) if len(values) > column else 0
+                    files[shard].write(line if line.endswith('\n') else line + '\n')
+                    counts[shard] += 1
+        finally:
+            for file in files:
+                file.close()
+        return paths, counts
+
+    def run_shard(self, name, filekey, shard, path, first_id, count):
+        """Worker side of import_sharded"""
+        result = {'shard': shard, 'rows': 0, 'countries': set(), 'error': None, 'deferred': [], 'counts': {}, 'stats': {}}
+        take_deferred() # ids recorded by the parent before the fork
+        self.writer = type(self.writer)(batch_size=self.writer.batch_size)
+        if first_id is not None:
+            self.writer.reserved = iter(xrange(first_id, first_id + count))
+        # metrics of this worker only, the parent adds them to its own
+        self.stats.current = Stage(self.stats.current.name)
+        self.writer.stats = self.stats
+
+        def data():
+            for item in self.read_data(filekey, path):
+                result['rows'] += 1
+                result['countries'].add(item['countryCode'])
+                yield item
+
+        try:
+            getattr(self, name)(data())
+            self.writer.flush()
+        except Exception:
+            result['error'] = traceback.format_exc()
+        result['countries'] = sorted(result['countries'])
+        result['deferred'] = list(take_deferred())
+        result['counts'] = dict(self.writer.report())
+        result['stats'] = self.stats.current.as_dict()
+        return result
+
+    def call_hook(self, hook, *args):
+        func = self.hook(hook)
+        return func(*args) if func else True
+
+    def hook(self, hook):
+        """
+        Function running the plugins of hook on a row, returning False if
+        the row must be skipped, or None when no plugin implements hook.
+        """
+        if not hasattr(self, 'hooks'): self.hooks = {}
+        if hook not in self.hooks:
+            self.hooks[hook] = self.compile_hook(hook)
+        return self.hooks[hook]
+
+    def compile_hook(self, hook):
+        plugins = settings.plugins.get(hook) if hasattr(settings, 'plugins') else None
+        if not plugins: return None
+        calls = [(getattr(plugin, hook), plugin_countries(plugin)) for plugin in plugins]
+        country_of = row_country[hook.rsplit('_', 1)[0]]
+        timer, skip, logger = self.stats.timer, self.stats.skip, self.logger
+        # {country: the functions that apply to it}
+        by_country = {}
+
+        def applicable(country):
+            if country not in by_country:
+                by_country[country] = [func for func, countries in calls
+                                       if countries is None or country is None or country in countries]
+            return by_country[country]
+
+        def run(*args):
+            # the row is the last argument of every hook
+            funcs = applicable(country_of(args[-1]) if country_of else None)
+            if not funcs: return True
+            with timer('hooks'):
+                for func in funcs:
+                    try:
+                        func(self, *args)
+                    except HookException as e:
+                        error = str(e)
+                        if error: logger.error(error)
+                        skip(hook)
+                        return False
+            return True
+        return run
+
+    def batches(self, data, stage, size=1000):
+        """
+        Pass the rows through the <stage>_pre_batch hooks, size rows at a
+        time. A batch hook receives the list of rows of its countries, may
+        change them and returns the rows to keep, or None to keep them all.
+        """
+        hook = stage + '_pre_batch'
+        plugins = settings.plugins.get(hook) if hasattr(settings, 'plugins') else None
+        if not plugins: return data
+        return self.run_batches(data, stage, hook, plugins, size)
+
+    def run_batches(self, data, stage, hook, plugins, size):
+        country_of = row_country[stage]
+        data = iter(data)
+        while True:
+            batch = list(islice(data, size))
+            if not batch: return
+            with self.stats.timer('hooks'):
+                for plugin in plugins:
+                    countries = plugin_countries(plugin)
+                    if countries is None or country_of is None:
+                        rows, others = batch, []
+                    else:
+                        rows, others = [], []
+                        for row in batch:
+                            (rows if country_of(row) in countries else others).append(row)
+                    if not rows: continue
+                    try:
+                        kept = getattr(plugin, hook)(self, rows)
+                    except HookException as e:
+                        error = str(e)
+                        if error: self.logger.error(error)
+                        kept = []
+                    if kept is not None:
+                        kept = list(kept)
+                        self.stats.skip(hook, len(rows) - len(kept))
+                        batch = others + kept
+            for row in batch:
+                yield row
+
+    def point(self, x, y):
+        # the copy engine writes hex EWKB as is, skip building GEOS points
+        if isinstance(self.writer, CopyWriter):
+            return ewkb_point(x, y)
+        return Point(x, y)
+
+    def download(self, filekey, **kwargs):
+        filename = settings.files[filekey]['filename'].format(**kwargs)
         urls = [e.format(filename=filename) for e in settings.files[filekey]['urls']]
-        for url in urls:
-            try:
-                web_file = urllib.urlopen(url)
-                if 'html' in web_file.headers['content-type']: raise Exception()
-                break
-            except:
-                web_file = None
-                continue
-        else:
-            self.logger.error("Web file not found: {0}. Tried URLs:\n{1}".format(filename, '\n'.join(urls)))
-            
-        uptodate = False
-        filepath = os.path.join(self.data_dir, filename)
-        if web_file is not None:
-            web_file_time = time.strptime(web_file.headers['last-modified'], '%a, %d %b %Y %H:%M:%S %Z')
-            web_file_size = int(web_file.headers['content-length'])
-            if os.path.exists(filepath):
-                file_time = time.gmtime(os.path.getmtime(filepath))
-                file_size = os.path.getsize(filepath)
-                if file_time >= web_file_time and file_size == web_file_size:
-                    self.logger.info("File up-to-date: " + filename)
-                    uptodate = True
-        else:
-            self.logger.warning("Assuming file is up-to-date")
-            uptodate = True
-            
-        if not uptodate and web_file is not None:
-            self.logger.info("Downloading: " + filename)
-            if not os.path.exists(self.data_dir):
-                os.makedirs(self.data_dir)
-            file = open(os.path.join(self.data_dir, filename), 'wb')
-            file.write(web_file.read())
-            file.close()
-        elif not os.path.exists(filepath):
-            raise Exception("File not found and download failed: " + filename)
-            
-        return uptodate
+        return Downloader(self.data_dir).download(urls, filename)
     
     def download_once(self, filekey):
         if filekey in self.download_cache: return self.download_cache[filekey]
         uptodate = self.download_cache[filekey] = self.download(filekey)
         return uptodate
 
-    def get_data(self, filekey):
-        filename = settings.files[filekey]['filename']
-        file = open(os.path.join(self.data_dir, filename), 'rb')
-        name, ext = filename.rsplit('.', 1)
-        if (ext == 'zip'):
-            file = zipfile.ZipFile(file).open(name + '.txt')
+    def get_data(self, filekey, **kwargs):
+        filename = settings.files[filekey]['filename'].format(**kwargs)
+        return self.read_data(filekey, os.path.join(self.data_dir, filename))
 
-        data = (
-            dict(zip(settings.files[filekey]['fields'], row.split("\t"))) 
-            for row in file if not row.startswith('#')
+    def read_data(self, filekey, filepath):
+        """Rows of the file at filepath, in the format of filekey"""
+        reader = Reader(
+            settings.files[filekey]['fields'],
+            settings.files[filekey].get('types'),
+            rejects=filepath + '.rejects',
         )
-
-        return data
-
-    def parse(self, data):
-        for line in data:
-            if len(line) < 1 or line[0] == '#': continue
-            items = [e.strip() for e in line.split('\t')]
-            yield items
+        return self.stats.rows(reader, open_data(filepath), filekey)
 
     def import_country(self):
         uptodate = self.download('country')
@@ -158,14 +391,18 @@ class Command(BaseCommand):
         countries = {}
 
         self.logger.info("Importing country data")
-        for item in data:
-            self.logger.info(item)
-            if not self.call_hook('country_pre', item): continue
+        pre, post = self.hook('country_pre'), self.hook('country_post')
+        for item in self.batches(data, 'country'):
+            self.logger.debug(item)
+            if pre and not pre(item): continue
             
             country = Country()
-            try: country.id = int(item['geonameid'])
-            except: 
+            country.geonames = True
+            country.geonames_hash = item.checksum()
+            if item['geonameid'] is None:
+                self.stats.skip('no_id')
                 continue
+            country.id = item['geonameid']
 
             country.name = item['name']
             country.slug = slugify(country.name)
@@ -178,17 +415,16 @@ class Command(BaseCommand):
             country.currency = item['currencyCode']
             country.currency_name = item['currencyName']
             country.capital = item['capital']
-            country.area = int(float(item['area'])) if item['area'] else None
+            country.area = int(item['area']) if item['area'] is not None else None
             country.languages = item['languages']
 
             neighbours[country] = item['neighbours'].split(",")
             countries[country.code] = country
             
-            if not self.call_hook('country_post', country, item): continue 
-            country.save()
-            # free some memory
-            # https://docs.djangoproject.com/en/dev/faq/models/
-            reset_queries()
+            if post and not post(country, item): continue 
+            self.writer.add(country)
+
+        self.writer.flush()
 
         for country, neighbour_codes in neighbours.items():
             neighbours = [x for x in [countries.get(x) for x in neighbour_codes if x] if x]
@@ -196,12 +432,13 @@ class Command(BaseCommand):
         
     def build_country_index(self):
         if hasattr(self, 'country_index'): return
-        
-        self.logger.info("Building country index")
-        self.country_index = {}
-        for obj in Country.objects.all():
-            self.country_index[obj.code] = obj
-            
+
+        with self.stats.timer('index'):
+            self.logger.info("Building country index")
+            self.country_index = {}
+            for obj in Country.objects.all():
+                self.country_index[obj.code] = obj
+
     def import_region(self):
         uptodate = self.download('region')
         if uptodate and not self.force: return
@@ -209,12 +446,15 @@ class Command(BaseCommand):
         self.build_country_index()
                 
         self.logger.info("Importing region data")
-        for item in data:
-            if not self.call_hook('region_pre', item): continue
+        pre, post = self.hook('region_pre'), self.hook('region_post')
+        for item in self.batches(data, 'region'):
+            if pre and not pre(item): continue
             
             region = Region()
+            region.geonames = True
+            region.geonames_hash = item.checksum()
 
-            region.id = int(item['geonameid'])
+            region.id = item['geonameid']
             region.name = item['name']
             region.name_std = item['asciiName']
             region.slug = slugify(region.name_std)
@@ -225,23 +465,26 @@ class Command(BaseCommand):
                 region.country = self.country_index[country_code]
             except:
                 self.logger.warning("{0}: {1}: Cannot find country: {2} -- skipping".format("COUNTRY", region.name, country_code))
+                self.stats.skip('no_country')
                 continue
             
-            if not self.call_hook('region_post', region, item): continue
-            region.save()
+            if post and not post(region, item): continue
+            self.writer.add(region)
+            # keep an index built by an earlier import current
+            if hasattr(self, 'region_index'): self.region_index[item['code']] = region
             self.logger.debug("Added region: {0}, {1}".format(item['code'], region))
-            # free some memory
-            # https://docs.djangoproject.com/en/dev/faq/models/
-            reset_queries()
         
     def build_region_index(self):
         if hasattr(self, 'region_index'): return
-        
-        self.logger.info("Building region index")
-        self.region_index = {}
-        for obj in chain(Region.objects.all(), Subregion.objects.all()):
-            self.region_index[obj.full_code()] = obj
-            
+
+        with self.stats.timer('index'):
+            self.logger.info("Building region index")
+            self.region_index = {}
+            # one joined query per type, full_code() then reads the cached parents
+            for obj in chain(Region.objects.select_related('country').iterator(),
+                             Subregion.objects.select_related('region__country').iterator()):
+                self.region_index[obj.full_code()] = obj
+
     def import_subregion(self):
         uptodate = self.download('subregion')
         if uptodate and not self.force: return
@@ -252,12 +495,15 @@ class Command(BaseCommand):
         self.build_region_index()
                 
         self.logger.info("Importing subregion data")
-        for item in data:
-            if not self.call_hook('subregion_pre', item): continue
+        pre, post = self.hook('subregion_pre'), self.hook('subregion_post')
+        for item in self.batches(data, 'subregion'):
+            if pre and not pre(item): continue
             
             subregion = Subregion()
+            subregion.geonames = True
+            subregion.geonames_hash = item.checksum()
 
-            subregion.id = int(item['geonameid'])
+            subregion.id = item['geonameid']
             subregion.name = item['name']
             subregion.name_std = item['asciiName']
             subregion.slug = slugify(subregion.name_std)
@@ -268,93 +514,118 @@ class Command(BaseCommand):
                 subregion.region = self.region_index[country_code + "." + region_code]
             except:
                 self.logger.warning("Subregion: {0}: Cannot find region: {1}".format(subregion.name, region_code))
+                self.stats.skip('no_region')
                 continue
                 
-            if not self.call_hook('subregion_post', subregion, item): continue
-            subregion.save()
+            if post and not post(subregion, item): continue
+            self.writer.add(subregion)
+            self.region_index[item['code']] = subregion
             self.logger.debug("Added subregion: {0}, {1}".format(item['code'], subregion))
-            # free some memory
-            # https://docs.djangoproject.com/en/dev/faq/models/
-            reset_queries()
-            
-        del self.region_index
         
     def import_city(self):            
         uptodate = self.download_once('city')
         if uptodate and not self.force: return
-        data = self.get_data('city')
 
         self.build_country_index()
         self.build_region_index()
 
         self.logger.info("Importing city data")
-        for item in data:
-            if not self.call_hook('city_pre', item): continue
-            
-            if item['featureCode'] not in city_types: continue
+        self.import_sharded(self.import_city_data, 'city')
 
-            city = City()
-            try:
-                city.id = int(item['geonameid'])
-            except:
-                continue
-            city.name = item['name']
-            city.kind = item['featureCode']
-            city.name_std = item['asciiName']
-            city.slug = slugify(city.name_std)
-            city.location = Point(float(item['longitude']), float(item['latitude']))
-            city.population = int(item['population'])
-            city.timezone = item['timezone']
-            try:
-                city.elevation = int(item['elevation'])
-            except:
-                pass
-
-            country_code = item['countryCode']
-            try: 
-                country = self.country_index[country_code]
-                city.country = country
-            except:
-                self.logger.warning("{0}: {1}: Cannot find country: {2} -- skipping".format("CITY", city.name, country_code))
-                continue
-
-            region_code = item['admin1Code']
-            try: 
-                region = self.region_index[country_code + "." + region_code]
-                city.region = region
-            except:
-                self.logger.warning("{0}: {1}: Cannot find region: {2} -- skipping".format(country_code, city.name, region_code))
-                continue
-            
-            subregion_code = item['admin2Code']
-            try: 
-                subregion = self.region_index[country_code + "." + region_code + "." + subregion_code]
-                city.subregion = subregion
-            except:
-                if subregion_code:
-                    self.logger.warning("{0}: {1}: Cannot find subregion: {2} -- skipping".format(country_code, city.name, subregion_code))
-                pass
-            
-            if not self.call_hook('city_post', city, item): continue
-            city.save()
+    def import_city_data(self, data):
+        for item in self.batches(data, 'city'):
+            city = self.make_city(item)
+            if city is None: continue
+            self.writer.add(city)
             self.logger.debug("Added city: {0}".format(city))
-            # free some memory
-            # https://docs.djangoproject.com/en/dev/faq/models/
-            reset_queries()
+
+    def make_city(self, item):
+        """City of a GeoNames row, None if the row is skipped"""
+        pre = self.hook('city_pre')
+        if pre and not pre(item): return
         
-    def build_hierarchy(self):
-        if hasattr(self, 'hierarchy'): return
+        if item['featureCode'] not in city_types:
+            self.stats.skip('feature_code')
+            return
+
+        city = City()
+        city.geonames = True
+        city.geonames_hash = item.checksum()
+        if item['geonameid'] is None:
+            self.stats.skip('no_id')
+            return
+        city.id = item['geonameid']
+        city.name = item['name']
+        city.kind = item['featureCode']
+        city.name_std = item['asciiName']
+        city.slug = slugify(city.name_std)
+        city.location = self.point(item['longitude'], item['latitude'])
+        city.population = item['population']
+        city.timezone = item['timezone']
+        city.elevation = item['elevation']
+
+        country_code = item['countryCode']
+        try: 
+            country = self.country_index[country_code]
+            city.country = country
+        except:
+            self.logger.warning("{0}: {1}: Cannot find country: {2} -- skipping".format("CITY", city.name, country_code))
+            self.stats.skip('no_country')
+            return
+
+        region_code = item['admin1Code']
+        try: 
+            region = self.region_index[country_code + "." + region_code]
+            city.region = region
+        except:
+            self.logger.warning("{0}: {1}: Cannot find region: {2} -- skipping".format(country_code, city.name, region_code))
+            self.stats.skip('no_region')
+            return
         
-        self.download('hierarchy')
-        data = self.get_data('hierarchy')
+        subregion_code = item['admin2Code']
+        try: 
+            subregion = self.region_index[country_code + "." + region_code + "." + subregion_code]
+            city.subregion = subregion
+        except:
+            if subregion_code:
+                self.logger.warning("{0}: {1}: Cannot find subregion: {2} -- skipping".format(country_code, city.name, subregion_code))
+            pass
         
-        self.logger.info("Building hierarchy index")
-        self.hierarchy = {}
-        for item in data:
-            parent_id = int(item['parent'])
-            child_id = int(item['child'])
-            self.hierarchy[child_id] = parent_id
-            
+        post = self.hook('city_post')
+        if post and not post(city, item): return
+        return city
+    
+    def build_hierarchy(self):
+        if hasattr(self, 'hierarchy'): return
+
+        with self.stats.timer('index'):
+            self.download('hierarchy')
+            data = self.get_data('hierarchy')
+
+            self.logger.info("Building hierarchy index")
+            self.hierarchy = HierarchyIndex((item['child'], item['parent']) for item in data)
+
+    def hierarchy_city(self, id, depth=4):
+        """Nearest ancestor of id in the hierarchy that is a known city"""
+        for i in range(depth):
+            id = self.hierarchy.get(id)
+            if id is None: return
+            city = self.city_index.get(id)
+            if city: return city
+
+    def build_city_index(self):
+        if hasattr(self, 'city_index'): return
+
+        with self.stats.timer('index'):
+            self.logger.info("Building city index")
+            self.city_index = {}
+            # large cities by location, for districts missing from the hierarchy
+            self.city_grid = PointGrid()
+            for obj in City.objects.all():
+                self.city_index[obj.id] = obj
+                if obj.population > 100000:
+                    self.city_grid.add(obj.location.x, obj.location.y, obj)
+
     def import_district(self):
         uptodate = self.download_once('city')
         if uptodate and not self.force: return
@@ -364,111 +635,126 @@ class Command(BaseCommand):
         self.build_country_index()
         self.build_region_index()
         self.build_hierarchy()
+        self.build_city_index()
             
         self.logger.info("Importing district data")
-        for item in data:
-            if not self.call_hook('district_pre', item): continue
+        pre, post = self.hook('district_pre'), self.hook('district_post')
+        for item in self.batches(data, 'district'):
+            if pre and not pre(item): continue
             
             type = item['featureCode']
-            if type not in district_types: continue
+            if type not in district_types:
+                self.stats.skip('feature_code')
+                continue
             
             district = District()
+            district.geonames = True
+            district.geonames_hash = item.checksum()
+            if item['geonameid'] is None:
+                self.stats.skip('no_id')
+                continue
+            district.id = item['geonameid']
             district.name = item['name']
             district.name_std = item['asciiName']
             district.slug = slugify(district.name_std)
-            district.location = Point(float(item['longitude']), float(item['latitude']))
-            district.population = int(item['population'])
+            longitude, latitude = item['longitude'], item['latitude']
+            district.location = self.point(longitude, latitude)
+            district.population = item['population']
             
             # Find city
-            city = None
-            try: 
-                city = City.objects.get(id=self.hierarchy[district.id])
-            except:
+            city = self.hierarchy_city(district.id)
+            if not city:
                 self.logger.warning("District: {0}: Cannot find city in hierarchy, using nearest".format(district.name))
-                city_pop_min = 100000
-                # we are going to try to find closet city using native database .distance(...) query but if that fails
-                # then we fall back to degree search, MYSQL has no support and Spatialite with SRID 4236. 
-                try:
-                    city = City.objects.filter(population__gt=city_pop_min).distance(district.location).order_by('distance')[0]
-                except:
-                    self.logger.warning("District: {0}: DB backend does not support native '.distance(...)' query " \
-                                        "falling back to two degree search".format(district.name))
-                    search_deg = 2
-                    min_dist = float('inf')
-                    bounds = Envelope(district.location.x-search_deg, district.location.y-search_deg,
-                                      district.location.x+search_deg, district.location.y+search_deg)
-                    for e in City.objects.filter(population__gt=city_pop_min).filter(location__intersects=bounds.wkt):
-                        dist = geo_distance(district.location, e.location)
-                        if dist < min_dist:
-                            min_dist = dist
-                            city = e
+                city = self.city_grid.nearest(longitude, latitude)
                     
             if not city:
                 self.logger.warning("District: {0}: Cannot find city -- skipping".format(district.name))
+                self.stats.skip('no_city')
                 continue
 
             district.city = city
             
-            if not self.call_hook('district_post', district, item): continue
-            district.save()
+            if post and not post(district, item): continue
+            self.writer.add(district)
             self.logger.debug("Added district: {0}".format(district))
-            # free some memory
-            # https://docs.djangoproject.com/en/dev/faq/models/
-            reset_queries()
         
+    def build_place_index(self):
+        if hasattr(self, 'place_ids'): return
+
+        with self.stats.timer('index'):
+            self.logger.info("Building place index")
+            # sorted machine ints, a fraction of the memory of a set of Python ints
+            self.place_ids = array('l', (row[0] for row in keyset(Place.objects.all(), [], 100000)))
+            # places created after the index was built, eg. by --incremental
+            self.added_place_ids = set()
+
+    def known_place(self, id):
+        if id in self.added_place_ids: return True
+        i = bisect_left(self.place_ids, id)
+        return i < len(self.place_ids) and self.place_ids[i] == id
+
     def import_alt_name(self):
         uptodate = self.download('alt_name')
         if uptodate and not self.force: return
         data = self.get_data('alt_name')
+
+        self.build_place_index()
         
         self.logger.info("Importing alternate name data")
-        for item in data:
-            if not self.call_hook('alt_name_pre', item): continue
+        self.import_alt_name_data(data)
+
+    def import_alt_name_data(self, data):
+        pre, post = self.hook('alt_name_pre'), self.hook('alt_name_post')
+        for item in self.batches(data, 'alt_name'):
+            if pre and not pre(item): continue
             
             # Only get names for languages in use
             locale = item['language']
             if not locale: locale = 'und'
             if not locale in settings.locales and 'all' not in settings.locales: 
-                self.logger.info("SKIPPING {0}".format(settings.locales))
+                self.stats.skip('language')
                 continue
             
             # Check if known geo id
-            geo_id = int(item['geonameid'])
-            try: geo_info = Place.objects.get(id=geo_id)
-            except Exception as e:
-                print e
+            geo_id = item['geonameid']
+            if not self.known_place(geo_id):
+                self.stats.skip('unknown_place')
                 continue
             
             alt = AlternativeName()
-            alt.id = int(item['nameid'])
+            alt.geonames = True
+            alt.geonames_hash = item.checksum()
+            alt.id = item['nameid']
             alt.name = item['name']
             alt.is_preferred = item['isPreferred']
             alt.is_short = item['isShort']
             alt.language = locale
 
-            if not self.call_hook('alt_name_post', alt, item): continue
-            alt.save()
-            geo_info.alt_names.add(alt)
+            if post and not post(alt, item): continue
+            self.writer.add(alt)
+            self.writer.link(Place.alt_names, geo_id, alt.id)
 
-            self.logger.debug("Added alt name: {0}, {1}".format(locale, alt))
-            # free some memory
-            # https://docs.djangoproject.com/en/dev/faq/models/
-            reset_queries()
+            self.logger.debug("Added alt name: {0}, {1}".format(locale, alt.name))
 
     def import_postal_code(self):
         uptodate = self.download('postal_code')
         if uptodate and not self.force: return
-        data = self.get_data('postal_code')
 
         self.build_country_index()
         self.build_region_index()
 
         self.logger.info("Importing postal codes")
-        for item in data:
-            if not self.call_hook('postal_code_pre', item): continue
+        self.import_sharded(self.import_postal_code_data, 'postal_code')
+
+    def import_postal_code_data(self, data):
+        pre, post = self.hook('postal_code_pre'), self.hook('postal_code_post')
+        for item in self.batches(data, 'postal_code'):
+            if pre and not pre(item): continue
 
             country_code = item['countryCode']
-            if country_code not in settings.postal_codes and 'ALL' not in settings.postal_codes: continue
+            if country_code not in settings.postal_codes and 'ALL' not in settings.postal_codes:
+                self.stats.skip('country_filter')
+                continue
 
             # Find country
             code = item['postalCode']
@@ -477,9 +763,14 @@ class Command(BaseCommand):
                 country = self.country_index[country_code]
             except:
                 self.logger.warning("Postal code: {0}: Cannot find country: {1} -- skipping".format(code, country_code))
+                self.stats.skip('no_country')
                 continue
 
             pc = PostalCode()
+            pc.geonames = True
+            pc.geonames_hash = item.checksum()
+            # postal codes have no geonameid, reuse the id of the same code on re-imports
+            pc.id = self.postal_code_id(country, code, item['placeName'], item['admin1Name'], item['admin2Name'], item['admin3Name'])
             pc.country = country
             pc.code = code
             pc.name = item['placeName']
@@ -487,21 +778,151 @@ class Command(BaseCommand):
             pc.subregion_name = item['admin2Name']
             pc.district_name = item['admin3Name']
 
-            try:
-                pc.location = Point(float(item['longitude']), float(item['latitude']))
-            except:
+            if item['longitude'] is None or item['latitude'] is None:
                 self.logger.warning("Postal code: {0}, {1}: Invalid location ({2}, {3})".format(pc.country, pc.code, item['longitude'], item['latitude']))
+                self.stats.skip('no_location')
                 continue
+            pc.location = self.point(item['longitude'], item['latitude'])
 
-            if not self.call_hook('postal_code_post', pc, item): continue
+            if post and not post(pc, item): continue
             self.logger.debug("Adding postal code: {0}, {1}".format(pc.country, pc))
+            self.writer.add(pc)
+
+    def postal_code_id(self, country, *key):
+        """
+        Stored id of the postal code with key (code, name and region names),
+        None for a new one. The key is not unique in the file, its ids are
+        handed out in order so each duplicate keeps its own row.
+        """
+        # the file is grouped by country, keep the ids of one country at a time
+        if getattr(self, 'postal_code_country', None) != country.id:
+            self.postal_code_country = country.id
+            self.postal_code_ids = defaultdict(list)
+            stored = PostalCode.objects.filter(country=country).order_by('pk').values_list(
+                'pk', 'code', 'name', 'region_name', 'subregion_name', 'district_name')
+            for row in stored.iterator():
+                self.postal_code_ids[row[1:]].append(row[0])
+        ids = self.postal_code_ids.get(key)
+        return ids.pop(0) if ids else None
+
+    def import_incremental(self):
+        """Apply the daily GeoNames changes, day by day, up to yesterday"""
+        state_path = os.path.join(self.data_dir, 'incremental.json')
+        try:
+            with open(state_path) as file:
+                last = json.load(file)['last']
+        except (IOError, ValueError, KeyError):
+            last = None
+
+        yesterday = datetime.utcnow().date() - timedelta(days=1)
+        if self.options['since']:
+            day = datetime.strptime(self.options['since'], '%Y-%m-%d').date()
+        elif last:
+            day = datetime.strptime(last, '%Y-%m-%d').date() + timedelta(days=1)
+        else:
+            day = yesterday
+
+        if not Place.objects.filter(geonames=True).exists() and Place.objects.exists():
+            # rows saved before the importer set geonames=True would all be skipped as local edits
+            raise CommandError("No place is marked as imported from GeoNames, "
+                               "run a full import (./manage.py cities --import=all --force) before --incremental")
+
+        self.build_country_index()
+        self.build_region_index()
+        self.build_place_index()
+        while day <= yesterday:
+            date = day.strftime('%Y-%m-%d')
             try:
-                pc.save()
-                # free some memory
-                # https://docs.djangoproject.com/en/dev/faq/models/
-                reset_queries()
-            except Exception, e:
-                print e
+                for filekey in ['modifications', 'deletes', 'alt_name_modifications', 'alt_name_deletes']:
+                    self.download(filekey, date=date)
+            except Exception as e:
+                self.logger.error("Daily files for {0} not available, stopping: {1}".format(date, e))
+                break
+
+            self.logger.info("Applying GeoNames changes of " + date)
+            self.import_modifications(self.get_data('modifications', date=date))
+            self.import_alt_name_data(self.geonames_rows(
+                AlternativeName, 'nameid', self.get_data('alt_name_modifications', date=date)))
+            self.writer.flush()
+            self.import_deletes(Place, 'geonameid', self.get_data('deletes', date=date))
+            self.import_deletes(AlternativeName, 'nameid', self.get_data('alt_name_deletes', date=date))
+
+            with open(state_path, 'w') as file:
+                json.dump({'last': date}, file)
+            day += timedelta(days=1)
+
+    def geonames_rows(self, model, field, data, chunk_size=1000):
+        """Skip rows of objects edited locally (geonames=False), looked up chunk by chunk"""
+        data = iter(data)
+        while True:
+            chunk = list(islice(data, chunk_size))
+            if not chunk: return
+            ids = [item[field] for item in chunk if item[field] is not None]
+            local = set(model.objects.filter(pk__in=ids, geonames=False).values_list('pk', flat=True)) if ids else set()
+            for item in chunk:
+                if item[field] not in local:
+                    yield item
+                else:
+                    self.stats.skip('local_edit')
+
+    def import_modifications(self, data, chunk_size=1000):
+        chunk = []
+        for item in self.geonames_rows(Place, 'geonameid', data):
+            if item['geonameid'] is None: continue
+            if self.known_place(item['geonameid']):
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    self.update_places(chunk)
+                    chunk = []
+            else:
+                city = self.make_city(item)
+                if city is None: continue
+                self.writer.add(city)
+                # its alternate names may follow, in this day's file or a later one
+                self.added_place_ids.add(city.id)
+                self.logger.debug("Added city: {0}".format(city.name))
+        self.update_places(chunk)
+
+    def update_places(self, items):
+        places = get_places([item['geonameid'] for item in items])
+        for item in items:
+            place = places.get(item['geonameid'])
+            if place is None: continue
+            place.geonames = True
+            place.geonames_hash = item.checksum()
+            place.name = item['name']
+            if hasattr(place, 'name_std'):
+                place.name_std = item['asciiName']
+                place.slug = slugify(place.name_std)
+            if hasattr(place, 'location') and item['longitude'] is not None and item['latitude'] is not None:
+                place.location = self.point(item['longitude'], item['latitude'])
+            if hasattr(place, 'population') and item['population'] is not None:
+                place.population = item['population']
+            if isinstance(place, City):
+                place.kind = item['featureCode']
+                place.timezone = item['timezone']
+                place.elevation = item['elevation']
+            self.writer.add(place)
+            self.logger.debug("Updated place: {0}".format(place.name))
+
+    def import_deletes(self, model, field, data, chunk_size=1000):
+        """Soft delete the rows listed in a GeoNames deletes file"""
+        ids = [item[field] for item in data if item[field] is not None]
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            count = model.objects.filter(pk__in=chunk, geonames=True).update(deleted=True)
+            self.logger.info("Deleted {0} {1}".format(count, model._meta.verbose_name_plural))
+            if model is Place:
+                if is_deferred(): defer(chunk)
+                forget_translations(chunk)
+            else:
+                places = list(Place.objects.filter(alt_names__in=chunk).distinct())
+                forget_translations([place.id for place in places])
+                if is_deferred():
+                    # the translated names of the places and of their descendants changed
+                    defer([place.id for place in places])
+                    for place in places:
+                        defer(subordinate_ids(place))
 
     def flush_country(self):
         self.logger.info("Flushing country data")
@@ -0,0 +1,23 @@
+import os
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ...snapshot import export
+from .cities import Command as ImportCommand
+
+class Command(BaseCommand):
+    args = '[path]'
+    help = 'Export the places to a read-only snapshot file, see cities.snapshot.Gazetteer.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--languages', default='',
+            help='Comma separated languages of the translated names, defaults to CITIES_AUTOCOMPLETE_LANGUAGES.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Usage: cities_snapshot " + self.args)
+        path = args[0] if args else os.path.join(ImportCommand.data_dir, 'cities.snapshot')
+        languages = [e for e in options['languages'].split(',') if e]
+        count = export(path, languages or None)
+        self.stdout.write("Exported {0} places to {1}\n".format(count, path))
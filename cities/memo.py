@@ -0,0 +1,95 @@
+"""
+Request-scoped identity map of places.
+
+Inside place_memo(), or a request handled with PlaceMemoMiddleware, each
+place is loaded once: Place.parent, subclass, hierarchy, translated and
+cities.models.get_places look it up in the map first, so listing the
+cities of one region resolves the region a single time. The map is
+bounded (CITIES_REQUEST_MEMO_SIZE entries) and dropped when the outermost
+block or the request ends.
+
+    with place_memo():
+        for city in City.objects.filter(region=region):
+            print city.translated_name('pt')
+"""
+
+import threading
+from contextlib import contextmanager
+from conf import settings
+from util import LRUCache
+
+_state = threading.local()
+
+class PlaceMemo(object):
+
+    def __init__(self, maxsize):
+        # place id -> concrete instance
+        self.places = LRUCache(maxsize)
+        # (lookup, key...) -> value
+        self.values = LRUCache(maxsize)
+
+    def place(self, id, load):
+        """The place with this id, load() it on the first use"""
+        place = self.places.get(id)
+        if place is None:
+            place = load()
+            if place is not None:
+                self.places.set(id, place)
+        return place
+
+    def clear(self):
+        self.places.clear()
+        self.values.clear()
+
+    def value(self, key, compute):
+        value = self.values.get(key, _missing)
+        if value is _missing:
+            value = compute()
+            self.values.set(key, value)
+        return value
+
+_missing = object()
+
+def current_memo():
+    """The active PlaceMemo, None outside place_memo()"""
+    return getattr(_state, 'memo', None)
+
+def start_memo(maxsize=None):
+    if getattr(_state, 'memo', None) is None:
+        _state.memo = PlaceMemo(maxsize or settings.request_memo_size)
+        _state.depth = 0
+    _state.depth += 1
+
+def end_memo():
+    _state.depth -= 1
+    if not _state.depth:
+        _state.memo = None
+
+@contextmanager
+def place_memo(maxsize=None):
+    """Share the places loaded in the block, nested blocks use the outer map"""
+    start_memo(maxsize)
+    try:
+        yield current_memo()
+    finally:
+        end_memo()
+
+class PlaceMemoMiddleware(object):
+    """One identity map per request, see place_memo()"""
+
+    def process_request(self, request):
+        start_memo()
+        request._place_memo = True
+
+    def process_response(self, request, response):
+        self.end(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self.end(request)
+
+    def end(self, request):
+        # process_response also runs after process_exception
+        if getattr(request, '_place_memo', False):
+            request._place_memo = False
+            end_memo()
@@ -1,12 +1,19 @@
 from django.utils.encoding import force_unicode
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
+from django.contrib.gis.db.models.query import GeoQuerySet
 from conf import settings
+from util import LRUCache, keyset, keyset_objects
+from memo import current_memo
+import placecache
 from django.db.models import BooleanField
 from django.utils.translation import ugettext_lazy as _
 from django.utils import translation
 from django.db import connections
 from django.db import transaction, reset_queries
+from django.core.exceptions import ObjectDoesNotExist
+from collections import defaultdict, OrderedDict
+from itertools import islice
 
 __all__ = [
         'Point', 'Country', 'Region', 'Subregion',
@@ -19,6 +26,164 @@ def get_or_none(classmodel, **kwargs):
     except classmodel.DoesNotExist:
         return None
 
+def get_places(ids):
+    """Concrete instances of the places with the given ids, by id"""
+    places = {}
+    if not ids: return places
+    memo = current_memo()
+    if memo is not None:
+        #places ja carregados nesta requisicao
+        for id in ids:
+            place = memo.places.get(id)
+            if place is not None: places[id] = place
+        ids = [id for id in ids if id not in places]
+        if not ids: return places
+    by_type = defaultdict(list)
+    for id, place_type in Place.objects.filter(pk__in=ids).values_list('pk', 'place_type'):
+        by_type[place_type].append(id)
+    for place_type, type_ids in by_type.items():
+        model = place_models.get(place_type)
+        if model:
+            places.update((p.id, p) for p in model.objects.filter(pk__in=type_ids))
+        else:
+            places.update((p.id, p.subclass) for p in Place.objects.filter(pk__in=type_ids))
+    if memo is not None:
+        for id in ids:
+            if id in places: memo.places.set(id, places[id])
+    return places
+
+def related_place(obj, name):
+    """The place of the foreign key obj.<name>, through the request identity map when active"""
+    memo = current_memo()
+    id = getattr(obj, name + '_id')
+    if memo is None or id is None:
+        return getattr(obj, name)
+    return memo.place(id, lambda: getattr(obj, name))
+
+def prefetch_hierarchy(places):
+    """Load the ancestors of all places at once, see Place.hierarchy"""
+    places = [p for p in places if p.ancestor_ids and not hasattr(p, '_hierarchy')]
+    ids = set()
+    for place in places:
+        ids.update(place.ancestor_list())
+        if type(place) is Place:
+            ids.add(place.id)
+    ancestors = get_places(ids)
+    for place in places:
+        subclass = ancestors.get(place.id, place) if type(place) is Place else place
+        place._hierarchy = [ancestors[id] for id in place.ancestor_list() if id in ancestors] + [subclass]
+
+#nomes traduzidos por idioma: {place id: nome ou None quando nao ha traducao}
+#expiram apos CITIES_TRANSLATION_CACHE_AGE segundos; com CITIES_CACHE todos os
+#processos descartam os nomes quando uma traducao muda, ver check_translations
+translation_caches = defaultdict(lambda: LRUCache(settings.translation_cache_size, settings.translation_cache_age))
+_no_translation = object()
+_translations_version = [None]
+
+def check_translations():
+    """Drop the translated names in memory if another process changed one since"""
+    version = placecache.translations_version()
+    if version != _translations_version[0]:
+        for cache in translation_caches.values():
+            cache.clear()
+        _translations_version[0] = version
+
+def preferred_names(rows):
+    """{place id: name} from (place id, name, is_preferred) rows, preferred names first"""
+    names = {}
+    preferred = set()
+    #mesma prioridade de Place.translated, is_preferred primeiro
+    for id, name, is_preferred in rows:
+        if id in preferred: continue
+        if is_preferred: preferred.add(id)
+        if is_preferred or id not in names:
+            names[id] = name
+    return names
+
+def translate_many(places, language=None, fresh=False):
+    """
+    Translated names of the places and of their ancestors, {place id: name}.
+    Places without a translation map to None. Names missing from the cache
+    are fetched with a single query, all of them with fresh.
+    """
+    language = (language or translation.get_language())[:2]
+    check_translations()
+    cache = translation_caches[language]
+    ids = set()
+    for place in places:
+        ids.add(place.id)
+        ids.update(place.ancestor_list())
+
+    names = {}
+    missing = []
+    for id in ids:
+        name = _no_translation if fresh else cache.get(id, _no_translation)
+        if name is _no_translation:
+            missing.append(id)
+        else:
+            names[id] = name
+    if missing:
+        found = preferred_names(Place.alt_names.through.objects.filter(
+            place__in=missing,
+            alternativename__language__startswith=language,
+            alternativename__active=True,
+            alternativename__deleted=False,
+        ).values_list('place', 'alternativename__name', 'alternativename__is_preferred'))
+        for id in missing:
+            names[id] = found.get(id)
+            cache.set(id, names[id])
+    return names
+
+def forget_translations(ids):
+    """Drop the cached translated names of the places, in every process with CITIES_CACHE"""
+    for cache in translation_caches.values():
+        for id in ids:
+            cache.discard(id)
+    placecache.bump_translations()
+
+class PlaceQuerySet(GeoQuerySet):
+    _with_hierarchy = False
+    _translation_language = None
+
+    def with_hierarchy(self):
+        """Prefetch the hierarchy of the places, chunk by chunk"""
+        return self._clone(_with_hierarchy=True)
+
+    def with_translations(self, language=None):
+        """Prefetch the translated names of the places and their ancestors"""
+        return self._clone(_translation_language=language or translation.get_language())
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_with_hierarchy', self._with_hierarchy)
+        kwargs.setdefault('_translation_language', self._translation_language)
+        return super(PlaceQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        places = super(PlaceQuerySet, self).iterator()
+        if not self._with_hierarchy and not self._translation_language:
+            for place in places:
+                yield place
+            return
+        while True:
+            chunk = list(islice(places, 100))
+            if not chunk: return
+            if self._with_hierarchy:
+                prefetch_hierarchy(chunk)
+            if self._translation_language:
+                translate_many(chunk, self._translation_language)
+            for place in chunk:
+                yield place
+
+class PlaceManager(models.GeoManager):
+    def get_query_set(self):
+        return PlaceQuerySet(self.model, using=self._db)
+
+    def with_hierarchy(self):
+        return self.get_query_set().with_hierarchy()
+
+    def with_translations(self, language=None):
+        return self.get_query_set().with_translations(language)
+
 class Place(models.Model):
     name = models.CharField(max_length=200, db_index=True, verbose_name="ascii name")
     slug = models.CharField(max_length=200)
@@ -35,8 +200,18 @@ class Place(models.Model):
     #a dica eh fazer a carga inicial da base do geonames ai apartir dai
     #todo novo place tem geonames igual a False
     geonames = BooleanField(default=False, verbose_name=_('geonames'))
+    #hash da linha do geonames que gerou o place, o importador pula as linhas inalteradas
+    geonames_hash = models.CharField(max_length=32, blank=True, editable=False)
+
+    #nome do model concreto (city, region, ...), evita descobrir o tipo com queries
+    place_type = models.CharField(max_length=20, blank=True, editable=False)
 
-    objects = models.GeoManager()
+    #caminho materializado: ids dos ancestrais, raiz primeiro (",1,5,"),
+    #e o get_absolute_url ja calculado. Vazio para places ainda nao calculados
+    ancestor_ids = models.CharField(max_length=200, blank=True, editable=False, db_index=True)
+    slug_path = models.TextField(blank=True, editable=False)
+
+    objects = PlaceManager()
 
     #utilizado para rankear os places, dessa forma em uma 
     #consulta pode-se ordenar os places segundo esse atributo
@@ -47,9 +222,28 @@ class Place(models.Model):
 
     @property
     def subclass(self):
+        if type(self) is not Place:
+            return self
+        if not hasattr(self, '_subclass'):
+            memo = current_memo()
+            if memo is None:
+                self._subclass = self.load_subclass()
+            else:
+                self._subclass = memo.place(self.id, self.load_subclass)
+        return self._subclass
+
+    def load_subclass(self):
+        model = place_models.get(self.place_type)
+        if model:
+            return get_or_none(model, pk=self.id) or self
+        return self.find_subclass()
+
+    def find_subclass(self):
+        """Probe every subclass, for rows saved without place_type"""
         for place in [City, District, Subregion, Region, Country, Continente]:
             p = get_or_none(place,pk=self.id) 
             if p:
+                #somente leitura, o tipo eh gravado por set_place_types()
                 return p
 
         return self
@@ -57,25 +251,92 @@ class Place(models.Model):
     @property
     def hierarchy(self):
         """Get hierarchy, root first"""
-        if isinstance(self,Place):
-            subclass = self.subclass
+        if not hasattr(self, '_hierarchy'):
+            memo = current_memo()
+            if memo is None or self.id is None:
+                self._hierarchy = self.load_hierarchy()
+            else:
+                self._hierarchy = memo.value(('hierarchy', self.id), self.load_hierarchy)
+        #os chamadores invertem a lista
+        return list(self._hierarchy)
+
+    def load_hierarchy(self):
+        subclass = self.subclass
+        if self.ancestor_ids:
+            ancestors = get_places(self.ancestor_list())
+            hierarchy = [ancestors[id] for id in self.ancestor_list() if id in ancestors]
+        else:
+            parent = subclass.parent
+            hierarchy = parent.hierarchy if parent else []
+        hierarchy.append(subclass)
+        return hierarchy
+
+    def ancestor_list(self):
+        return [int(e) for e in self.ancestor_ids.split(',') if e]
+
+    def build_path(self):
+        """Compute ancestor_ids and slug_path from the parent"""
+        try:
+            parent = self.subclass.parent
+        except ObjectDoesNotExist:
+            parent = None
+        if parent is None:
+            self.ancestor_ids = ','
+            self.slug_path = self.slug
+            return
+        if not parent.ancestor_ids:
+            parent.build_path()
+        self.ancestor_ids = parent.ancestor_ids + str(parent.id) + ','
+        self.slug_path = self.slug + '/' + parent.slug_path
+
+    def update_descendant_paths(self, old_ancestor_ids, old_slug_path):
+        """Rewrite the paths of the descendants after this place's path changed, in one UPDATE"""
+        old_prefix = old_ancestor_ids + str(self.id) + ','
+        new_prefix = self.ancestor_ids + str(self.id) + ','
+        connection = connections['default']
+        if connection.vendor == 'mysql':
+            concat, length = "CONCAT({0}, {1})", "CHAR_LENGTH"
         else:
-            subclass = self
-        list = subclass.parent.hierarchy if subclass.parent else []
-        list.append(subclass)
-        return list
+            concat, length = "{0} || {1}", "LENGTH"
+        #troca o prefixo dos ancestrais e o final do slug_path (o caminho antigo deste place)
+        ancestor_ids = concat.format("%s", "SUBSTR(ancestor_ids, %s)")
+        old_end = "SUBSTR(slug_path, {0}(slug_path) - %s + 1)".format(length)
+        slug_path = "CASE WHEN {0}(slug_path) >= %s AND {1} = %s THEN {2} ELSE slug_path END".format(
+            length, old_end, concat.format("SUBSTR(slug_path, 1, {0}(slug_path) - %s)".format(length), "%s"))
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE {0} SET slug_path = {1}, ancestor_ids = {2} WHERE ancestor_ids LIKE %s".format(
+                connection.ops.quote_name(Place._meta.db_table), slug_path, ancestor_ids),
+            [len(old_slug_path), len(old_slug_path), old_slug_path, len(old_slug_path), self.slug_path,
+             new_prefix, len(old_prefix) + 1, old_prefix + '%']
+        )
 
     def get_absolute_url(self):
+        if self.slug_path:
+            return self.slug_path
+        if self.id is not None and placecache.enabled():
+            return placecache.absolute_urls([self])[self.id]
+        return self.compute_absolute_url()
+
+    def compute_absolute_url(self):
         h = self.hierarchy
         h.reverse()
         return "/".join([place.slug for place in h])
 
     def get_absolute_slug(self):
+        if self.slug_path:
+            return self.slug_path.replace('/', '-')
         h = self.hierarchy
         h.reverse()
         return "-".join([place.slug for place in h])
 
     def translated(self, language=translation.get_language()):
+        memo = current_memo()
+        if memo is not None and self.id is not None:
+            return memo.value(('translated', self.id, language[:2]), lambda: self.load_translated(language))
+        return self.load_translated(language)
+
+    def load_translated(self, language):
         alts = self.alt_names.filter(
             language__startswith=language[:2], #equiparando idiomas, ISO 639-1 soh possui duas letras
             active=True, 
@@ -85,86 +346,122 @@ class Place(models.Model):
         return alts[0] if len(alts)>0 else self
 
     def __unicode__(self):
-        h = self.hierarchy
-        h.reverse()
-        alt_h=[]
-        for p in h:
-            language = translation.get_language()
-            alt_h.append(p.translated(language))
-        return ", ".join([p.name for p in alt_h])
+        return self.translated_name(translation.get_language())
 
     def translated_name(self,language=translation.get_language()):
+        if self.id is not None and placecache.enabled():
+            return placecache.translated_names([self], language)[self.id]
+        return self.compute_translated_name(language)
+
+    def compute_translated_name(self, language):
         h = self.hierarchy
         h.reverse()
-        alt_h=[]
-        for p in h:
-            alt_h.append(p.translated(language))
-        return ", ".join([p.name for p in alt_h])
+        names = translate_many(h, language)
+        return ", ".join([names.get(p.id) or p.name for p in h])
 
     def original_name(self):
         h = self.hierarchy
         h.reverse()
         return ", ".join([p.name for p in h])
 
-    #TODO: otimizar consumo de memoria
     def subordinates(self):
+        """List of the subordinate places, see iter_subordinates() for large subtrees"""
+        return list(self.iter_subordinates())
+
+    def iter_subordinates(self, types=None, fields=None, ids=False, chunk_size=1000):
+        """
+        Stream the subordinate places, type by type and chunk by chunk in id
+        order, so memory stays bounded whatever the size of the subtree.
+        types: models to include, by default those of subordinates() for the
+        type of this place (any descendant type once paths are computed).
+        fields: load only these fields. ids: yield ids instead of instances.
+        """
         sub = self.subclass
-        if type(sub)==City:
-            return []
-        elif type(sub)==Region:
-            cities = City.objects.filter(region__id=self.id)
-            return list(cities)
-        elif type(sub)==Country:
-            cities = City.objects.filter(country__id=self.id)
-            regions = Region.objects.filter(country__id=self.id)
-            return list(cities)+list(regions)
-        elif type(sub)==Continente:
-            cities_regions=[]
-            countries=Country.objects.filter(continent=sub.code)
-            for c in countries:
-                cities_regions += c.subordinates()
-            return list(countries) + cities_regions
-
-    def update_autocomplete(self, update_subordinates=False):
-        orig = Place.objects.get(pk=self.id)
+        filters = subordinate_filters.get(type(sub), {})
+        for model in (types or filters.keys()):
+            if self.ancestor_ids:
+                #caminho materializado: todos os descendentes pelo prefixo
+                queryset = model.objects.filter(ancestor_ids__startswith=self.ancestor_ids + str(self.id) + ',')
+            elif model in filters:
+                queryset = model.objects.filter(**filters[model](sub))
+            else:
+                continue
+            if ids:
+                for row in keyset(queryset, [], chunk_size):
+                    yield row[0]
+            else:
+                if fields: queryset = queryset.only(*fields)
+                for place in keyset_objects(queryset, chunk_size):
+                    yield place
+
+    def update_autocomplete(self, update_subordinates=False, changed=None):
+        """
+        Rewrite the autocomplete rows of this place, and of its subordinates
+        with update_subordinates. changed: the saved object the background
+        refresh waits for, see refresh_subordinates_async.
+        """
+        from autocomplete import autocomplete_tables, has_search_name, normalize
+        from autocomplete import refresh_subordinates, refresh_subordinates_async, update_caches
+
+        tables = autocomplete_tables()
 
         #atualizando place
-        for language in ['pt','en']:
-                if 'cities_table_autocomplete_'+language[:2] in connections['default'].introspection.table_names():
-                    sql = "UPDATE cities_table_autocomplete_%s SET name='%s', slug='%s', active=%s, deleted=%s, ranking=%s WHERE id=%s;" % (
-                        language,
-                        self.translated_name(language).replace("'",'"'),
-                        self.get_absolute_url(),
-                        self.active,
-                        self.deleted,
-                        self.ranking,
-                        self.id
-                    )
-                    cursor = connections['default'].cursor()
-                    cursor.execute(sql)
+        for language, table in tables.items():
+            name = self.translated_name(language).replace("'",'"')
+            sql = "UPDATE %s SET name=%%s, slug=%%s, active=%%s, deleted=%%s, ranking=%%s WHERE id=%%s;" % table
+            params = [name, self.get_absolute_url(), self.active, self.deleted, self.ranking, self.id]
+            if has_search_name():
+                #coluna normalizada usada pela busca por prefixo
+                sql = sql.replace(" WHERE", ", search_name=%s WHERE")
+                params.insert(-1, normalize(name))
+            cursor = connections['default'].cursor()
+            cursor.execute(sql, params)
+        update_caches([self.id])
 
         #atualizando places subordinados, pois os subordinados possuem o name/slug do superior
-        if orig.name!=self.name or orig.slug!=self.slug or update_subordinates:
-            places=self.subordinates()
-            for language in ['pt','en']:
-                if 'cities_table_autocomplete_'+language[:2] in connections['default'].introspection.table_names():
-                    for p in places:
-                        sql = "UPDATE cities_table_autocomplete_%s SET name='%s', slug='%s' WHERE id=%s;" % (
-                            language,
-                            p.translated_name(language).replace("'",'"'),
-                            p.get_absolute_url(),
-                            p.id
-                        )
-                        cursor = connections['default'].cursor()
-                        cursor.execute(sql)
+        #em lotes, ou numa thread de fundo para nao bloquear o admin;
+        #refresh_places tambem descarta os nomes do cache compartilhado
+        if update_subordinates and (tables or placecache.enabled()):
+            if settings.autocomplete_async:
+                refresh_subordinates_async(self, changed)
+            else:
+                refresh_subordinates(self)
 
     def save(self, *args, **kwargs):
-        #dado alterado passa a nao pertencer mais ao geonames
-        self.geonames = False
+        from autocomplete import is_deferred, defer, subordinate_ids
+
+        #dado alterado passa a nao pertencer mais ao geonames,
+        #exceto quando gravado pelo importador (geonames=True)
+        self.geonames = kwargs.pop('geonames', False)
+        #o mapa da requisicao pode guardar a versao anterior deste place
+        memo = current_memo()
+        if memo is not None: memo.clear()
+        if type(self) is not Place:
+            self.place_type = self._meta.module_name
+
+        old = list(Place.objects.filter(pk=self.id).values_list('ancestor_ids', 'slug_path', 'name')) if self.id else []
+        old_path = [row[:2] for row in old]
+        self.build_path()
+        self.__dict__.pop('_hierarchy', None)
 
         super(Place, self).save(*args, **kwargs)
 
-        self.update_autocomplete()
+        #os descendentes guardam o caminho deste place
+        if old_path and old_path[0][0] and tuple(old_path[0]) != (self.ancestor_ids, self.slug_path):
+            self.update_descendant_paths(*old_path[0])
+
+        #os subordinados repetem o nome e o caminho deste place
+        renamed = bool(old) and (old[0][1], old[0][2]) != (self.slug_path, self.name)
+
+        #nomes e urls guardados no cache compartilhado
+        placecache.invalidate([self.id])
+
+        #dentro de deferred_autocomplete() a atualizacao eh feita no final
+        if is_deferred():
+            defer([self.id])
+            if renamed: defer(subordinate_ids(self))
+        else:
+            self.update_autocomplete(renamed)
 
 '''
 Coloquei continente em portugues, pois quando estava colocando apenas
@@ -178,10 +475,23 @@ class Continente(Place):
         verbose_name = _('continente')
         verbose_name_plural = _('continentes')
 
+    objects = PlaceManager()
+
     @property
     def parent(self):
         return None
 
+    def save(self, *args, **kwargs):
+        super(Continente, self).save(*args, **kwargs)
+
+        #paises referenciam o continente pelo codigo, atualiza os que ainda nao o tem no caminho
+        for country in Country.objects.filter(continent=self.code).exclude(ancestor_ids__startswith=',%s,' % self.id):
+            old_path = (country.ancestor_ids, country.slug_path)
+            country.build_path()
+            Place.objects.filter(pk=country.id).update(ancestor_ids=country.ancestor_ids, slug_path=country.slug_path)
+            if old_path[0]:
+                country.update_descendant_paths(*old_path)
+
 class Country(Place):
     code = models.CharField(max_length=2, db_index=True)
     code3 = models.CharField(max_length=3, db_index=True)
@@ -200,8 +510,13 @@ class Country(Place):
         ordering = ['name']
         verbose_name_plural = "countries"
 
+    objects = PlaceManager()
+
     @property
     def parent(self):
+        memo = current_memo()
+        if memo is not None:
+            return memo.value(('continente', self.continent), lambda: Continente.objects.get(code=self.continent))
         return Continente.objects.get(code=self.continent)
 
 class Region(Place):
@@ -209,9 +524,11 @@ class Region(Place):
     code = models.CharField(max_length=200, db_index=True)
     country = models.ForeignKey(Country)
 
+    objects = PlaceManager()
+
     @property
     def parent(self):
-        return self.country
+        return related_place(self, 'country')
 
     def full_code(self):
         return ".".join([self.parent.code, self.code])
@@ -221,9 +538,11 @@ class Subregion(Place):
     code = models.CharField(max_length=200, db_index=True)
     region = models.ForeignKey(Region)
 
+    objects = PlaceManager()
+
     @property
     def parent(self):
-        return self.region
+        return related_place(self, 'region')
 
     def full_code(self):
         return ".".join([self.parent.parent.code, self.parent.code, self.code])
@@ -239,14 +558,14 @@ class City(Place):
     kind = models.CharField(max_length=10) # http://www.geonames.org/export/codes.html
     timezone = models.CharField(max_length=40) 
 
-    objects = models.GeoManager()
+    objects = PlaceManager()
 
     class Meta:
         verbose_name_plural = "cities"
 
     @property
     def parent(self):
-        return self.region
+        return related_place(self, 'region')
 
 class District(Place):
     name_std = models.CharField(max_length=200, db_index=True, verbose_name="standard name")
@@ -254,9 +573,11 @@ class District(Place):
     population = models.IntegerField()
     city = models.ForeignKey(City)
 
+    objects = PlaceManager()
+
     @property
     def parent(self):
-        return self.city
+        return related_place(self, 'city')
 
 class AlternativeName(models.Model):
     name = models.CharField(max_length=256)
@@ -276,6 +597,8 @@ class AlternativeName(models.Model):
     #a dica eh fazer a carga inicial da base do geonames ai apartir dai
     #todo novo dado tem geonames igual a False
     geonames = BooleanField(default=False, verbose_name=_('geonames'))
+    #hash da linha do geonames que gerou o dado, o importador pula as linhas inalteradas
+    geonames_hash = models.CharField(max_length=32, blank=True, editable=False)
 
     def __unicode__(self):
         place = Place.objects.filter(alt_names__id=self.id)
@@ -285,15 +608,24 @@ class AlternativeName(models.Model):
             return self.name
 
     def save(self, *args, **kwargs):
-        #dado alterado passa a nao pertencer mais ao geonames
-        self.geonames = False
+        #dado alterado passa a nao pertencer mais ao geonames,
+        #exceto quando gravado pelo importador (geonames=True)
+        self.geonames = kwargs.pop('geonames', False)
+        memo = current_memo()
+        if memo is not None: memo.clear()
+
+        from autocomplete import saved_values
 
         orig = AlternativeName.objects.get(pk=self.id)
 
         super(AlternativeName, self).save(*args, **kwargs)
 
         place = Place.objects.get(alt_names__id=self.id)
-        place.update_autocomplete(True if orig.name!=self.name else False)
+        forget_translations([place.id])
+        placecache.invalidate([place.id])
+        #idioma, preferencia e situacao tambem mudam o nome traduzido dos subordinados
+        cascade = saved_values(orig)[2] != saved_values(self)[2]
+        place.update_autocomplete(cascade, changed=self)
 
 class PostalCode(Place):
     code = models.CharField(max_length=20)
@@ -306,11 +638,11 @@ class PostalCode(Place):
     subregion_name = models.CharField(max_length=100, db_index=True)
     district_name = models.CharField(max_length=100, db_index=True)
 
-    objects = models.GeoManager()
+    objects = PlaceManager()
 
     @property
     def parent(self):
-        return self.country
+        return related_place(self, 'country')
 
     @property
     def name_full(self):
@@ -330,3 +662,52 @@ class PostalCode(Place):
 
     def __unicode__(self):
         return force_unicode(self.code)
+
+#subordinados de cada tipo de place: model -> filtro, para places sem caminho calculado
+subordinate_filters = {
+    Region: OrderedDict([
+        (City, lambda p: {'region': p.id}),
+    ]),
+    Country: OrderedDict([
+        (City, lambda p: {'country': p.id}),
+        (Region, lambda p: {'country': p.id}),
+    ]),
+    Continente: OrderedDict([
+        (Country, lambda p: {'continent': p.code}),
+        (City, lambda p: {'country__continent': p.code}),
+        (Region, lambda p: {'country__continent': p.code}),
+    ]),
+}
+
+#tipos concretos de Place pelo valor de Place.place_type
+place_models = dict(
+    (model._meta.module_name, model)
+    for model in [City, District, Subregion, Region, Country, Continente, PostalCode]
+)
+
+def set_place_types():
+    """Fill place_type of the places saved without it, one UPDATE per type"""
+    for name, model in place_models.items():
+        Place.objects.filter(place_type='', pk__in=model.objects.values('pk')).update(place_type=name)
+
+def set_place_paths(chunk_size=1000):
+    """Fill ancestor_ids and slug_path of the places saved without them, root types first"""
+    table = connections['default'].ops.quote_name(Place._meta.db_table)
+    for model, parent in [(Continente, None), (Country, None), (Region, 'country'), (Subregion, 'region'),
+                          (City, 'region'), (District, 'city'), (PostalCode, 'country')]:
+        pending = model.objects.filter(ancestor_ids='')
+        if parent:
+            pending = pending.select_related(parent)
+        while True:
+            places = list(pending[:chunk_size])
+            if not places: break
+            for place in places:
+                place.build_path()
+            cursor = connections['default'].cursor()
+            cursor.executemany(
+                "UPDATE %s SET ancestor_ids=%%s, slug_path=%%s WHERE id=%%s" % table,
+                [(p.ancestor_ids, p.slug_path, p.id) for p in places]
+            )
+            # free some memory
+            # https://docs.djangoproject.com/en/dev/faq/models/
+            reset_queries()
@@ -0,0 +1,139 @@
+"""
+Translated names and URLs of places shared by every process through
+Django's cache framework.
+
+With CITIES_CACHE set to a cache alias (eg. 'default', a locmem cache in
+tests, memcached or redis in production) Place.translated_name() and the
+hierarchy based get_absolute_url() read their result from the cache, and
+translated_names() / absolute_urls() resolve whole lists with one
+get_many. Keys are 'cities:name:<id>:<language>' and 'cities:url:<id>',
+stored under a generation number kept in the cache itself.
+
+Saving a place or an alternative name deletes the keys of the place; when
+its name or path changed, the keys of its descendants are deleted with
+their autocomplete rows by refresh_places(), in the background thread with
+CITIES_AUTOCOMPLETE_ASYNC. invalidate_all() moves to a new generation, eg.
+after rebuilding the autocomplete tables.
+"""
+
+import time
+from itertools import islice
+from conf import settings
+
+generation_key = 'cities:generation'
+# changed whenever a translated name changes, see cities.models.translate_many
+translations_key = 'cities:translations'
+
+_backend = []
+
+def get_backend():
+    """The configured cache, None when CITIES_CACHE is not set"""
+    if not _backend:
+        from django.core.cache import get_cache
+        _backend.append(get_cache(settings.cache) if settings.cache else None)
+    return _backend[0]
+
+def enabled():
+    return get_backend() is not None
+
+def generation(cache, key=generation_key):
+    value = cache.get(key)
+    if value is None:
+        # a new number, keys of a lost generation can not come back
+        cache.add(key, int(time.time() * 1000), settings.cache_timeout)
+        value = cache.get(key)
+    return value
+
+def next_generation(cache, key=generation_key):
+    # never back to an earlier number, even within the same millisecond
+    value = max(int(time.time() * 1000), (cache.get(key) or 0) + 1)
+    cache.set(key, value, settings.cache_timeout)
+
+def name_key(id, language):
+    return 'cities:name:{0}:{1}'.format(id, language[:2])
+
+def url_key(id):
+    return 'cities:url:{0}'.format(id)
+
+def cached(keys, compute):
+    """
+    {key: value} for keys, reading them with one get_many; compute(missing
+    keys) returns the values of the missing ones, which are stored.
+    """
+    cache = get_backend()
+    version = generation(cache)
+    found = cache.get_many(keys, version=version)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        computed = compute(missing)
+        cache.set_many(computed, settings.cache_timeout, version=version)
+        found.update(computed)
+    return found
+
+def translated_names(places, language):
+    """{place id: place.translated_name(language)}, through the cache"""
+    from models import prefetch_hierarchy, translate_many
+
+    language = language[:2]
+    if not enabled() or language not in settings.cache_languages:
+        return dict((place.id, place.compute_translated_name(language)) for place in places)
+    by_key = dict((name_key(place.id, language), place) for place in places)
+
+    def compute(keys):
+        missing = [by_key[key] for key in keys]
+        prefetch_hierarchy(missing)
+        # from the database, the names in memory may be older than the shared entries
+        translate_many([p for place in missing for p in place.hierarchy], language, fresh=True)
+        return dict((key, by_key[key].compute_translated_name(language)) for key in keys)
+
+    found = cached(by_key.keys(), compute)
+    return dict((place.id, found[key]) for key, place in by_key.items())
+
+def absolute_urls(places):
+    """{place id: place.get_absolute_url()}, through the cache for places without slug_path"""
+    from models import prefetch_hierarchy
+
+    urls = dict((place.id, place.slug_path) for place in places if place.slug_path)
+    pending = [place for place in places if not place.slug_path]
+    if not pending: return urls
+    if not enabled():
+        urls.update((place.id, place.compute_absolute_url()) for place in pending)
+        return urls
+    by_key = dict((url_key(place.id), place) for place in pending)
+
+    def compute(keys):
+        missing = [by_key[key] for key in keys]
+        prefetch_hierarchy(missing)
+        return dict((key, by_key[key].compute_absolute_url()) for key in keys)
+
+    found = cached(by_key.keys(), compute)
+    urls.update((place.id, found[key]) for key, place in by_key.items())
+    return urls
+
+def invalidate(ids, chunk_size=1000):
+    """Delete the cached names and URL of the place ids, ids may be a generator"""
+    if not enabled(): return
+    cache = get_backend()
+    version = generation(cache)
+    ids = iter(ids)
+    while True:
+        chunk = list(islice(ids, chunk_size))
+        if not chunk: break
+        keys = [url_key(id) for id in chunk]
+        keys += [name_key(id, language) for id in chunk for language in settings.cache_languages]
+        cache.delete_many(keys, version=version)
+
+def invalidate_all():
+    """Drop every cached entry by moving to a new generation"""
+    if not enabled(): return
+    next_generation(get_backend())
+
+def translations_version():
+    """Shared number changed by bump_translations(), None without CITIES_CACHE"""
+    if not enabled(): return None
+    return generation(get_backend(), translations_key)
+
+def bump_translations():
+    """Tell every process to drop its in-memory translated names"""
+    if not enabled(): return
+    next_generation(get_backend(), translations_key)
@@ -17,6 +17,9 @@ code_map = {
 }
 
 class Plugin:
+    # only called for Canadian rows
+    countries = ['CA']
+
     def postal_code_pre(self, parser, item):
         country_code = item['countryCode']
         if country_code != 'CA': return
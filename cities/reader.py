@@ -0,0 +1,154 @@
+"""
+Streaming reader for the GeoNames tab separated files.
+
+Lines are decoded from UTF-8 by the file object, split once and the
+declared numeric columns converted once. Rows are small __slots__ objects
+over the list of values that can still be read and written by field name,
+like the dicts plugin hooks used to receive. Malformed lines are appended
+to a reject file instead of failing the import.
+
+Run as a script to compare it with the former dict based parsing:
+
+    python -m cities.reader cities/data/cities5000.zip
+"""
+
+import io
+import os
+import sys
+import time
+import zipfile
+import hashlib
+
+class Row(object):
+    """A parsed line, fields accessed by name: row['geonameid']"""
+    __slots__ = ('values',)
+    fields = ()
+    index = {}
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.index[key]]
+
+    def __setitem__(self, key, value):
+        self.values[self.index[key]] = value
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def get(self, key, default=None):
+        i = self.index.get(key)
+        return default if i is None else self.values[i]
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return zip(self.fields, self.values)
+
+    def checksum(self):
+        """md5 of the values, to tell whether a row changed since the last import"""
+        line = u"\t".join([u"" if value is None else unicode(value) for value in self.values])
+        return hashlib.md5(line.encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+def row_class(fields):
+    """Row subclass for a file with the given fields"""
+    return type('Row', (Row,), {
+        '__slots__': (),
+        'fields': tuple(fields),
+        'index': dict((field, i) for i, field in enumerate(fields)),
+    })
+
+class Reader(object):
+    """
+    Parse lines into rows. types maps field names to converters, eg. int or
+    float, applied to non empty values; empty values become None.
+    """
+
+    def __init__(self, fields, types=None, rejects=None):
+        self.row_class = row_class(fields)
+        self.width = len(fields)
+        types = types or {}
+        self.converters = [(i, types[field]) for i, field in enumerate(fields) if field in types]
+        self.rejects = rejects
+        self.rejects_file = None
+        self.rejected = 0
+
+    def read(self, lines):
+        row_class, width, converters = self.row_class, self.width, self.converters
+        try:
+            for number, line in enumerate(lines, 1):
+                if line[:1] == '#' or not line.strip(): continue
+                values = line.rstrip('\r\n').split('\t')
+                if len(values) < width:
+                    self.reject(number, line, "expected {0} columns, got {1}".format(width, len(values)))
+                    continue
+                try:
+                    for i, convert in converters:
+                        value = values[i]
+                        values[i] = convert(value) if value else None
+                except ValueError as e:
+                    self.reject(number, line, str(e))
+                    continue
+                yield row_class(values)
+        finally:
+            if self.rejects_file:
+                self.rejects_file.close()
+                self.rejects_file = None
+
+    def reject(self, number, line, reason):
+        self.rejected += 1
+        if not self.rejects: return
+        if self.rejects_file is None:
+            self.rejects_file = io.open(self.rejects, 'w', encoding='utf-8')
+        self.rejects_file.write(u"{0}\t{1}\t{2}\n".format(number, reason, line.rstrip('\r\n')))
+
+def open_data(path):
+    """Text stream of a data file, or of the .txt member of a zip archive"""
+    directory, filename = os.path.split(path)
+    name, ext = filename.rsplit('.', 1)
+    if ext == 'zip':
+        return io.TextIOWrapper(zipfile.ZipFile(path).open(name + '.txt'), encoding='utf-8')
+    return io.open(path, encoding='utf-8')
+
+def benchmark(path, repeat=3):
+    """Time the dict based parsing against Reader over the whole file"""
+    with open_data(path) as file:
+        for line in file:
+            if not line.startswith('#'): break
+    fields = ['f{0}'.format(i) for i in range(len(line.split('\t')))]
+    types = {'f0': int, 'f4': float, 'f5': float, 'f14': int}
+
+    def dicts():
+        directory, filename = os.path.split(path)
+        name, ext = filename.rsplit('.', 1)
+        file = open(path, 'rb')
+        if ext == 'zip':
+            file = zipfile.ZipFile(file).open(name + '.txt')
+        for item in (dict(zip(fields, row.split("\t"))) for row in file if not row.startswith('#')):
+            try: int(item['f0']); float(item['f4']); float(item['f5']); int(item['f14'])
+            except ValueError: pass
+
+    def rows():
+        with open_data(path) as file:
+            for row in Reader(fields, types).read(file):
+                pass
+
+    for name, func in [('dict', dicts), ('reader', rows)]:
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{0:8} {1:.3f}s".format(name, best))
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
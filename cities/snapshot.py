@@ -0,0 +1,223 @@
+"""
+Read-only gazetteer snapshot.
+
+export() writes every place with its type, parent, name, URL and
+translated names into one file of fixed-width columns and string pools.
+Gazetteer maps the file with mmap and answers lookups with struct reads on
+the mapped pages: no database, no ORM and nothing loaded up front, and all
+the processes opening the same file share its pages through the page cache.
+
+    gazetteer = Gazetteer('cities.snapshot')
+    gazetteer.country('BR').name
+    gazetteer.region('BR.27').get_absolute_url()
+    gazetteer.city(3448439).translated_name('pt')
+
+Layout: an 8 byte magic, the offset of the JSON directory, then the
+sections, 8 byte aligned. Integer columns are little-endian int64, row
+numbers index the places sorted by id. A string pool is a column of
+count + 1 offsets into a section of UTF-8 data.
+"""
+
+import os
+import json
+import mmap
+import struct
+
+magic = 'CITIES01'
+
+class Gazetteer(object):
+    """Lookups on a snapshot file written by export()"""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(magic)] != magic:
+            raise ValueError("Not a cities snapshot: " + path)
+        directory_offset, = struct.unpack_from('<Q', self.map, len(magic))
+        directory = json.loads(self.map[directory_offset:])
+        self.sections = directory['sections']
+        self.types = directory['types']
+        self.languages = directory['languages']
+        self.count = directory['count']
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def integer(self, section, i):
+        return struct.unpack_from('<q', self.map, self.sections[section] + 8 * i)[0]
+
+    def raw(self, pool, i):
+        start, end = struct.unpack_from('<2q', self.map, self.sections[pool + '_offsets'] + 8 * i)
+        data = self.sections[pool + '_data']
+        return self.map[data + start:data + end]
+
+    def string(self, pool, i):
+        return self.raw(pool, i).decode('utf-8')
+
+    def find_id(self, id):
+        """Row of the place id, None if unknown"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.integer('ids', mid) < id: lo = mid + 1
+            else: hi = mid
+        if lo < self.count and self.integer('ids', lo) == id:
+            return lo
+
+    def find_key(self, pool, key):
+        """Row of the place with the code key, pools of codes are sorted"""
+        key = key.encode('utf-8')
+        lo, hi = 0, self.sections[pool + '_count']
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(pool, mid) < key: lo = mid + 1
+            else: hi = mid
+        if lo < self.sections[pool + '_count'] and self.raw(pool, lo) == key:
+            return self.integer(pool + '_rows', lo)
+
+    def record(self, row):
+        return None if row is None else PlaceRecord(self, row)
+
+    def place(self, id):
+        return self.record(self.find_id(id))
+
+    def city(self, id):
+        place = self.place(id)
+        return place if place and place.type == 'city' else None
+
+    def country(self, code):
+        return self.record(self.find_key('country_code', code))
+
+    def region(self, full_code):
+        """Region or subregion by full code, eg. 'US.CA' or 'US.CA.037'"""
+        return self.record(self.find_key('region_code', full_code))
+
+class PlaceRecord(object):
+    """A place of the snapshot, with the read-only part of the Place API"""
+    __slots__ = ('gazetteer', 'row')
+
+    def __init__(self, gazetteer, row):
+        self.gazetteer = gazetteer
+        self.row = row
+
+    @property
+    def id(self):
+        return self.gazetteer.integer('ids', self.row)
+
+    @property
+    def type(self):
+        return self.gazetteer.types[ord(self.gazetteer.map[self.gazetteer.sections['types'] + self.row])]
+
+    @property
+    def name(self):
+        return self.gazetteer.string('name', self.row)
+
+    @property
+    def parent(self):
+        return self.gazetteer.record(self.parent_row())
+
+    def parent_row(self):
+        row = self.gazetteer.integer('parents', self.row)
+        return None if row < 0 else row
+
+    @property
+    def hierarchy(self):
+        """Get hierarchy, root first"""
+        places = [self]
+        parent = self.parent
+        while parent is not None and len(places) < 16:
+            places.append(parent)
+            parent = parent.parent
+        places.reverse()
+        return places
+
+    def get_absolute_url(self):
+        return self.gazetteer.string('url', self.row)
+
+    def translated_name(self, language):
+        pool = 'name_' + language[:2]
+        if pool + '_offsets' not in self.gazetteer.sections:
+            pool = 'name'
+        h = self.hierarchy
+        h.reverse()
+        return ", ".join([self.gazetteer.string(pool, p.row) or p.name for p in h])
+
+    def __eq__(self, other):
+        return isinstance(other, PlaceRecord) and (self.gazetteer, self.row) == (other.gazetteer, other.row)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<PlaceRecord: {0} {1}>".format(self.type, self.id)
+
+def export(path, languages=None, using='default'):
+    """Write the places of the database to a snapshot file at path"""
+    from conf import settings
+    from autocomplete import NameIndex
+    from models import Place, Country, Region, Subregion, place_models
+
+    languages = [language[:2] for language in (languages or settings.autocomplete_languages)]
+    index = NameIndex(languages, using)
+    ids = sorted(index.names)
+    rows = dict((id, row) for row, id in enumerate(ids))
+    types = [''] + sorted(place_models)
+    place_types = dict(Place.objects.using(using).values_list('pk', 'place_type').iterator())
+
+    sections = [
+        ('ids', int64s(ids)),
+        ('types', struct.pack('<%dB' % len(ids), *[types.index(place_types.get(id) or '') for id in ids])),
+        ('parents', int64s([rows.get(index.parents.get(id), -1) for id in ids])),
+    ]
+    sections += pool('name', [index.names[id] for id in ids])
+    sections += pool('url', [index.get_absolute_url(id) for id in ids])
+    for language in languages:
+        names = index.translations.get(language, {})
+        sections += pool('name_' + language, [names.get(id) or u'' for id in ids])
+
+    countries = Country.objects.using(using).values_list('code', 'pk')
+    regions = [(country + '.' + code, id) for code, country, id in
+               Region.objects.using(using).values_list('code', 'country__code', 'pk').iterator()]
+    regions += [(country + '.' + region + '.' + code, id) for code, region, country, id in
+                Subregion.objects.using(using).values_list('code', 'region__code', 'region__country__code', 'pk').iterator()]
+    counts = {}
+    for name, keys in [('country_code', countries), ('region_code', regions)]:
+        keys = sorted((key.encode('utf-8'), rows[id]) for key, id in keys if id in rows)
+        sections += pool(name, [key for key, row in keys])
+        sections.append((name + '_rows', int64s([row for key, row in keys])))
+        counts[name + '_count'] = len(keys)
+
+    write(path, sections, counts, {'types': types, 'languages': languages, 'count': len(ids)})
+    return len(ids)
+
+def write(path, sections, counts, directory):
+    """Write the (name, data) sections and the directory"""
+    # write next to the file and rename, processes still mapping the old file keep it
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(magic + struct.pack('<Q', 0))
+        offsets = dict(counts)
+        for name, data in sections:
+            file.write('\0' * (-file.tell() % 8))
+            offsets[name] = file.tell()
+            file.write(data)
+        directory_offset = file.tell()
+        file.write(json.dumps(dict(directory, sections=offsets)))
+        file.seek(len(magic))
+        file.write(struct.pack('<Q', directory_offset))
+    os.rename(tmp, path)
+
+def int64s(values):
+    return struct.pack('<%dq' % len(values), *values)
+
+def pool(name, strings):
+    """Offsets and data sections of a string pool"""
+    offsets, data, size = [0], [], 0
+    for string in strings:
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+        data.append(string)
+        size += len(string)
+        offsets.append(size)
+    return [(name + '_offsets', int64s(offsets)), (name + '_data', ''.join(data))]
@@ -0,0 +1,187 @@
+"""
+Per-stage metrics of the import.
+
+A stage is one import (country, city, ...). For each stage ImportStats
+keeps the rows read, the rows skipped by reason, the rows written by
+model, the queries issued, the time spent parsing, in plugin hooks, in
+the database and building indexes, and the peak RSS of the process, and
+can profile it with cProfile.
+"""
+
+import os
+import time
+import json
+import logging
+import resource
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from django.db import connections
+
+class Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.read = Counter()
+        self.counts = Counter()
+        self.skipped = Counter()
+        self.written = {}
+        self.times = Counter()
+        self.queries = 0
+        self.elapsed = 0.0
+        self.peak_rss_kb = 0
+        self.children_peak_rss_kb = 0
+
+    def merge(self, data):
+        """
+        Add the as_dict() of the same stage run in another process, eg. a
+        worker of a sharded import, which reads its own shard of the file.
+        """
+        self.read.update(data['rows_read'])
+        self.counts.update(data['counts'])
+        self.skipped.update(data['skipped'])
+        self.times.update(data['times'])
+        self.queries += data['queries']
+        for model, counts in data['written'].items():
+            self.written.setdefault(model, Counter()).update(counts)
+
+    def as_dict(self):
+        return {
+            'rows_read': dict(self.read),
+            'counts': dict(self.counts),
+            'skipped': dict(self.skipped),
+            'written': dict((model, dict(counts)) for model, counts in self.written.items()),
+            'times': dict(self.times),
+            'queries': self.queries,
+            'elapsed': self.elapsed,
+            'peak_rss_kb': self.peak_rss_kb,
+            'children_peak_rss_kb': self.children_peak_rss_kb,
+        }
+
+class QueryCounter(object):
+    """Cursor wrapper counting the statements run through it"""
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, *args, **kwargs):
+        self.stats.current.queries += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.stats.current.queries += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class ImportStats(object):
+    logger = logging.getLogger("cities")
+
+    def __init__(self, progress=None, profile_dir=None, using='default'):
+        """
+        progress: seconds between progress lines, None for none.
+        profile_dir: directory of the <stage>.prof cProfile dumps, None for none.
+        """
+        self.progress = progress
+        self.profile_dir = profile_dir
+        self.using = using
+        self.stages = OrderedDict()
+        self.current = Stage(None)
+
+    @contextmanager
+    def stage(self, name):
+        previous = self.current
+        self.current = self.stages.setdefault(name, Stage(name))
+        self.started = self.last_progress = time.time()
+        connection = connections[self.using]
+        cursor = connection.cursor
+        connection.cursor = lambda: QueryCounter(cursor(), self)
+        profile = None
+        if self.profile_dir:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield self.current
+        finally:
+            self.current.elapsed += time.time() - self.started
+            if profile:
+                profile.disable()
+                if not os.path.exists(self.profile_dir):
+                    os.makedirs(self.profile_dir)
+                profile.dump_stats(os.path.join(self.profile_dir, name + '.prof'))
+            del connection.cursor
+            self.current.peak_rss_kb, self.current.children_peak_rss_kb = peak_rss_kb()
+            self.current = previous
+
+    @contextmanager
+    def timer(self, key):
+        """Add the time spent in the block to times[key] of the current stage"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.current.times[key] += time.time() - start
+
+    def count(self, key, n=1):
+        self.current.counts[key] += n
+
+    def skip(self, reason, n=1):
+        self.current.skipped[reason] += n
+
+    def written(self, model, counts):
+        self.current.written.setdefault(model, Counter()).update(counts)
+
+    def rows(self, reader, lines, name):
+        """
+        Rows of reader.read(lines), counting the rows read from the file
+        name and the time spent parsing them, and logging the progress.
+        """
+        stage = self.current
+        rows = reader.read(lines)
+        while True:
+            start = time.time()
+            try:
+                row = next(rows)
+            except StopIteration:
+                stage.times['parse'] += time.time() - start
+                if reader.rejected:
+                    stage.skipped['malformed'] += reader.rejected
+                return
+            now = time.time()
+            stage.times['parse'] += now - start
+            stage.read[name] += 1
+            if self.progress and now - self.last_progress >= self.progress:
+                self.last_progress = now
+                self.log_progress(stage, now)
+            yield row
+
+    def log_progress(self, stage, now):
+        self.logger.info("{0}: {1} rows read, {2:.0f} rows/s, {3} skipped, {4} queries".format(
+            stage.name, sum(stage.read.values()), sum(stage.read.values()) / max(now - self.started, 1e-6),
+            sum(stage.skipped.values()), stage.queries))
+
+    def report(self):
+        return OrderedDict((name, stage.as_dict()) for name, stage in self.stages.items())
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+@contextmanager
+def timed(stats, key):
+    """stats.timer(key), or nothing when there are no stats"""
+    if stats is None:
+        yield
+    else:
+        with stats.timer(key):
+            yield
+
+def peak_rss_kb():
+    """Peak resident set size of the process and of its largest finished child, KB on Linux"""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
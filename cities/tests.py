@@ -0,0 +1,192 @@
+"""
+Tests of the GeoNames downloader against a local HTTP server, and of the
+incremental import with the writer replaced by a list.
+
+The downloader tests need neither Django settings nor a database:
+
+    python -m unittest cities.tests
+
+The import tests run with the project's settings (./manage.py test cities)
+and are skipped without them.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import urllib2
+from array import array
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from cities.download import Downloader
+
+try:
+    from django.conf import settings as django_settings
+    has_django = bool(django_settings.INSTALLED_APPS)
+except Exception:
+    has_django = False
+
+payload = ''.join(chr(i % 251) for i in xrange(200000))
+etag = '"v1"'
+
+class GeoNamesHandler(BaseHTTPRequestHandler):
+    """Serves payload with an ETag, conditional and Range requests"""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.path.endswith('.html'):
+            return self.reply(200, '<html></html>', {'Content-Type': 'text/html'})
+        if self.headers.get('If-None-Match') == etag and not self.headers.get('Range'):
+            return self.reply(304, '')
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') == etag:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(payload):
+                return self.reply(416, '')
+            return self.reply(206, payload[start:], {
+                'Content-Range': 'bytes {0}-{1}/{2}'.format(start, len(payload) - 1, len(payload))})
+        self.reply(200, payload)
+
+    def reply(self, code, body, headers={}):
+        self.send_response(code)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), GeoNamesHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/cities.zip'.format(self.server.server_port)
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, 'cities.zip')
+        self.downloader = Downloader(self.data_dir, timeout=5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def read(self, path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def test_download(self):
+        self.assertFalse(self.downloader.download([self.url], 'cities.zip'))
+        self.assertEqual(self.read(self.path), payload)
+        manifest = json.loads(self.read(self.path + '.json'))
+        self.assertEqual(manifest['etag'], etag)
+        self.assertEqual(manifest['size'], len(payload))
+        self.assertEqual(manifest['sha256'], hashlib.sha256(payload).hexdigest())
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_not_modified(self):
+        self.downloader.download([self.url], 'cities.zip')
+        self.assertTrue(self.downloader.download([self.url], 'cities.zip'))
+        self.assertEqual(self.server.requests[-1].get('if-none-match'), etag)
+
+    def test_resume(self):
+        with open(self.path + '.part', 'wb') as file:
+            file.write(payload[:50000])
+        self.downloader.write_manifest(self.path + '.part', {'url': self.url, 'etag': etag})
+        self.assertFalse(self.downloader.download([self.url], 'cities.zip'))
+        self.assertEqual(self.server.requests[-1].get('range'), 'bytes=50000-')
+        self.assertEqual(self.read(self.path), payload)
+        manifest = json.loads(self.read(self.path + '.json'))
+        self.assertEqual(manifest['sha256'], hashlib.sha256(payload).hexdigest())
+
+    def test_invalid_range(self):
+        with open(self.path + '.part', 'wb') as file:
+            file.write(payload + 'x')
+        self.downloader.write_manifest(self.path + '.part', {'url': self.url, 'etag': etag})
+        with self.assertRaises(urllib2.HTTPError):
+            self.downloader.fetch(self.url, self.path)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        # the next attempt starts over
+        self.assertFalse(self.downloader.download([self.url], 'cities.zip'))
+        self.assertEqual(self.read(self.path), payload)
+
+    def test_corrupted_file(self):
+        self.downloader.download([self.url], 'cities.zip')
+        with open(self.path, 'r+b') as file:
+            file.write('corrupted')
+        self.assertFalse(self.downloader.download([self.url], 'cities.zip'))
+        self.assertNotIn('if-none-match', self.server.requests[-1])
+        self.assertEqual(self.read(self.path), payload)
+
+    def test_html_page(self):
+        url = self.url.replace('.zip', '.html')
+        with self.assertRaises(Exception):
+            self.downloader.download([url], 'cities.zip')
+        self.assertFalse(os.path.exists(self.path))
+
+class ListWriter(object):
+    """Keeps what the import writes"""
+
+    def __init__(self):
+        self.objs = []
+        self.links = []
+
+    def add(self, obj):
+        self.objs.append(obj)
+
+    def link(self, descriptor, source_id, target_id):
+        self.links.append((source_id, target_id))
+
+    def flush(self):
+        pass
+
+def tsv_rows(filekey, rows):
+    """Rows of filekey parsed from {field: value} dicts"""
+    from cities.conf import settings
+    from cities.reader import Reader
+
+    fields = settings.files[filekey]['fields']
+    lines = [u"\t".join([unicode(row.get(field, u"")) for field in fields]) + u"\n" for row in rows]
+    return list(Reader(fields, settings.files[filekey].get('types')).read(lines))
+
+@unittest.skipUnless(has_django, "needs the Django settings of a project")
+class IncrementalImportTest(unittest.TestCase):
+
+    def setUp(self):
+        from cities.models import Country, Region
+        from cities.stats import ImportStats
+        from cities.management.commands.cities import Command
+
+        self.command = Command()
+        self.command.stats = ImportStats()
+        self.command.writer = ListWriter()
+        self.command.geonames_rows = lambda model, field, data: data
+        self.command.country_index = {'BR': Country(id=1, code='BR')}
+        self.command.region_index = {'BR.27': Region(id=2, code='27')}
+        self.command.place_ids = array('l', [1, 2])
+        self.command.added_place_ids = set()
+
+    def test_new_place_keeps_its_alternate_names(self):
+        self.command.import_modifications(tsv_rows('modifications', [{
+            'geonameid': 999, 'name': u'Nova', 'asciiName': u'Nova', 'latitude': 1.0, 'longitude': 2.0,
+            'featureClass': 'P', 'featureCode': 'PPL', 'countryCode': 'BR', 'admin1Code': '27',
+        }]))
+        self.assertEqual([obj.id for obj in self.command.writer.objs], [999])
+
+        self.command.import_alt_name_data(tsv_rows('alt_name_modifications', [
+            {'nameid': 5000, 'geonameid': 999, 'language': 'und', 'name': u'Nova'},
+            {'nameid': 5001, 'geonameid': 12345, 'language': 'und', 'name': u'Unknown'},
+        ]))
+        self.assertEqual(self.command.writer.links, [(999, 5000)])
+        self.assertEqual(self.command.stats.current.skipped['unknown_place'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
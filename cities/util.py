@@ -1,14 +1,221 @@
 import re
-from math import radians, sin, cos, acos
+import time
+import struct
+import threading
+from collections import OrderedDict, defaultdict
+from binascii import hexlify
+from math import radians, sin, cos, asin, sqrt, pi, ceil, floor
 from django.contrib.gis.geos import Point
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
     
 earth_radius_km = 6371.009
 
 def geo_distance(a, b):
     """Distance between two geo points in km. (p.x = long, p.y = lat)"""
-    a_y = radians(a.y)
-    b_y = radians(b.y)
-    delta_x = radians(a.x - b.x)
-    cos_x = (   sin(a_y) * sin(b_y) +
-                cos(a_y) * cos(b_y) * cos(delta_x))
-    return acos(cos_x) * earth_radius_km
+    return point_distance(a.x, a.y, b.x, b.y)
+
+def point_distance(a_x, a_y, b_x, b_y):
+    """Distance in km between two (long, lat) pairs"""
+    # haversine, unlike the spherical law of cosines it stays exact for close points
+    a_y = radians(a_y)
+    b_y = radians(b_y)
+    h = (   sin((b_y - a_y) / 2) ** 2 +
+            cos(a_y) * cos(b_y) * sin(radians(b_x - a_x) / 2) ** 2)
+    return 2 * asin(sqrt(min(1.0, h))) * earth_radius_km
+
+def haversine(a_x, a_y, b_x, b_y):
+    """Distances in km between (long, lat) numpy arrays, broadcast against each other"""
+    a_y = numpy.radians(a_y)
+    b_y = numpy.radians(b_y)
+    h = (   numpy.sin((b_y - a_y) / 2) ** 2 +
+            numpy.cos(a_y) * numpy.cos(b_y) * numpy.sin(numpy.radians(b_x - a_x) / 2) ** 2)
+    return 2 * numpy.arcsin(numpy.sqrt(numpy.minimum(1.0, h))) * earth_radius_km
+
+def distance_matrix(a_x, a_y, b_x=None, b_y=None):
+    """Pairwise distances in km, rows for the a points and columns for the b points"""
+    if b_x is None:
+        b_x, b_y = a_x, a_y
+    a_x, a_y = numpy.asarray(a_x, float)[:, None], numpy.asarray(a_y, float)[:, None]
+    return haversine(a_x, a_y, numpy.asarray(b_x, float)[None, :], numpy.asarray(b_y, float)[None, :])
+
+class PointArray(object):
+    """
+    Ids and coordinates of places in numpy arrays, for vectorized distance
+    and nearest neighbour queries without spatial database support.
+    """
+    _models = {}
+
+    def __init__(self, ids, xs, ys):
+        if numpy is None:
+            raise ImportError("PointArray requires numpy")
+        self.ids = numpy.asarray(ids, dtype=numpy.int64)
+        self.xs = numpy.asarray(xs, dtype=float)
+        self.ys = numpy.asarray(ys, dtype=float)
+
+    @classmethod
+    def from_queryset(cls, queryset, field='location'):
+        ids, xs, ys = [], [], []
+        for id, point in queryset.values_list('pk', field).iterator():
+            if point is None: continue
+            ids.append(id)
+            xs.append(point.x)
+            ys.append(point.y)
+        return cls(ids, xs, ys)
+
+    @classmethod
+    def for_model(cls, model, field='location'):
+        """Array of all rows of model, loaded once per process"""
+        if model not in cls._models:
+            cls._models[model] = cls.from_queryset(model.objects.all(), field)
+        return cls._models[model]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def distances(self, x, y):
+        """Distances in km from (x, y) to every point"""
+        return haversine(x, y, self.xs, self.ys)
+
+    def k_nearest(self, x, y, k, exclude=()):
+        """The k closest (id, km) pairs to (x, y), closest first"""
+        dist = self.distances(x, y)
+        if exclude:
+            dist[numpy.in1d(self.ids, list(exclude))] = numpy.inf
+        k = min(k, len(dist))
+        if not k: return []
+        candidates = numpy.argpartition(dist, k - 1)[:k]
+        candidates = candidates[numpy.argsort(dist[candidates])]
+        return [(int(self.ids[i]), float(dist[i])) for i in candidates if numpy.isfinite(dist[i])]
+
+class PointGrid(object):
+    """
+    Values bucketed by location in cell_size degree cells, for nearest
+    neighbour lookups in memory, without spatial database support.
+    """
+
+    def __init__(self, cell_size=1.0):
+        self.cell_size = cell_size
+        self.columns = int(ceil(360.0 / cell_size))
+        self.rows = int(ceil(180.0 / cell_size))
+        self.cells = defaultdict(list)
+        self.count = 0
+
+    def add(self, x, y, value):
+        self.cells[self.cell(x, y)].append((x, y, value))
+        self.count += 1
+
+    def cell(self, x, y):
+        column = int(floor((x + 180.0) / self.cell_size)) % self.columns
+        row = min(int(floor((y + 90.0) / self.cell_size)), self.rows - 1)
+        return column, row
+
+    def ring(self, column, row, r):
+        """Cells at exactly r cells from (column, row), wrapping around the antimeridian"""
+        if r == 0:
+            return [(column, row)]
+        columns = set((column + dx) % self.columns for dx in range(-r, r + 1))
+        cells = set()
+        for dy in (-r, r):
+            cells.update((c, row + dy) for c in columns)
+        for dx in (-r, r):
+            c = (column + dx) % self.columns
+            cells.update((c, row + dy) for dy in range(-r + 1, r))
+        return [(c, w) for c, w in cells if 0 <= w < self.rows]
+
+    def nearest(self, x, y):
+        """The value closest to (x, y), or None if the grid is empty"""
+        if not self.count: return None
+        column, row = self.cell(x, y)
+        best, best_dist = None, float('inf')
+        for r in range(max(self.columns, self.rows)):
+            for cell in self.ring(column, row, r):
+                for p_x, p_y, value in self.cells.get(cell, ()):
+                    dist = point_distance(x, y, p_x, p_y)
+                    if dist < best_dist:
+                        best, best_dist = value, dist
+            if best is not None and self.min_distance(y, r) > best_dist:
+                break
+        return best
+
+    def min_distance(self, y, r):
+        """Lower bound in km of the distance from latitude y to points beyond ring r"""
+        gap = radians(r * self.cell_size)
+        max_lat = min(pi / 2, abs(radians(y)) + gap)
+        # a longitude gap shrinks with latitude, 2/pi covers the great circle shortcut
+        return gap * cos(max_lat) * 2 / pi * earth_radius_km
+
+def ewkb_point(x, y, srid=4326):
+    """Hex EWKB of a point, accepted by geometry fields without building a GEOS object"""
+    # little endian, point type with the SRID flag, srid, x, y
+    return hexlify(struct.pack('<BIIdd', 1, 0x20000001, srid, x, y)).upper()
+
+class LRUCache(object):
+    """
+    Thread safe mapping keeping the maxsize most recently used entries,
+    for at most max_age seconds when given.
+    """
+
+    def __init__(self, maxsize=10000, max_age=None):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, stored = self.data.pop(key)
+            except KeyError:
+                return default
+            if self.max_age and time.time() - stored > self.max_age:
+                return default
+            self.data[key] = (value, stored)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, time.time())
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def keys(self):
+        with self.lock:
+            return list(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+def keyset_objects(queryset, chunk_size=1000):
+    """Iterate the instances of queryset in pk order, chunk by chunk"""
+    last = None
+    while True:
+        qs = queryset if last is None else queryset.filter(pk__gt=last)
+        objs = list(qs.order_by('pk')[:chunk_size])
+        if not objs: return
+        for obj in objs:
+            yield obj
+        last = objs[-1].pk
+
+def keyset(queryset, fields, chunk_size=1000):
+    """Iterate (pk, *fields) of queryset in pk order, chunk by chunk"""
+    last = None
+    while True:
+        qs = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = list(qs.order_by('pk').values_list('pk', *fields)[:chunk_size])
+        if not rows: return
+        for row in rows:
+            yield row
+        last = rows[-1][0]
@@ -2,7 +2,22 @@ from django.conf.urls.defaults import *
 from django.conf.urls import patterns
 from django.contrib import admin
 from django.views.generic import ListView
+from django.contrib.gis.measure import D
 from cities.models import Country, Region, City, District, PostalCode
+from cities.util import PointArray
+
+def nearest(model, point, k, exclude=()):
+    """The k rows of model closest to point, with their distance, computed in memory"""
+    found = PointArray.for_model(model).k_nearest(point.x, point.y, k, exclude)
+    objects = model.objects.in_bulk([id for id, km in found])
+    result = []
+    for id, km in found:
+        # the array is loaded once per process, the row may be gone since
+        obj = objects.get(id)
+        if obj is None: continue
+        obj.distance = D(km=km)
+        result.append(obj)
+    return result
 
 class PlaceListView(ListView):
     template_name = "list.html"
@@ -32,8 +47,8 @@ class PlaceListView(ListView):
         context['place'] = self.place
 
         if hasattr(self.place, 'location'):
-            context['nearby'] = City.objects.distance(self.place.location).exclude(id=self.place.id).order_by('distance')[:10]
-            context['postal'] = PostalCode.objects.distance(self.place.location).order_by('distance')[:10]
+            context['nearby'] = nearest(City, self.place.location, 10, exclude=[self.place.id])
+            context['postal'] = nearest(PostalCode, self.place.location, 10)
         return context
 
 admin.autodiscover()